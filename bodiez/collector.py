@@ -1,8 +1,15 @@
-from dataclasses import asdict, dataclass, field
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime
+from functools import cached_property
+import hashlib
 from pprint import pformat
 import json
 import logging
+import os
+import queue
 import re
+import threading
 import time
 from typing import Callable, List
 from urllib.parse import urlparse, unquote_plus
@@ -10,17 +17,26 @@ from urllib.parse import urlparse, unquote_plus
 from svcutils.notifier import notify
 
 from bodiez import NAME
-from bodiez.parsers.base import get_url_domain_name, iterate_parsers
-from bodiez.store import CloudSyncStore
+from bodiez import metrics
+from bodiez.fetcher import DomainThrottler, fetch, get_url_domain_name
+from bodiez.metrics import timed
+from bodiez.store import get_key_digest, get_store
 
 logger = logging.getLogger(__name__)
 
 
+CLEAN_TITLE_PATTERNS = [
+    (re.compile(r'\([^)]*\)'), ''),
+    (re.compile(r'\[[^]]*\]'), ''),
+    (re.compile(r'\([^(]*$|\[[^[]*$'), ''),
+    (re.compile(r'\s{2,}'), ' '),
+]
+
+
 def clean_title(title):
-    res = re.sub(r'\([^)]*\)', '', title)
-    res = re.sub(r'\[[^]]*\]', '', res)
-    res = re.sub(r'\([^(]*$|\[[^[]*$', '', res)
-    res = re.sub(r'\s{2,}', ' ', res)
+    res = title
+    for pattern, repl in CLEAN_TITLE_PATTERNS:
+        res = pattern.sub(repl, res)
     return res.strip()
 
 
@@ -32,16 +48,34 @@ def to_json(x):
     return json.dumps(x, sort_keys=True, indent=4)
 
 
+def format_ts(ts):
+    return datetime.fromtimestamp(ts).isoformat(sep=' ', timespec='seconds')
+
+
+def get_mtime(file):
+    return os.path.getmtime(file) if file and os.path.exists(file) else None
+
+
 @dataclass
 class Query:
     url: str
     id: str = None
     active: bool = True
     update_delta: int = 2 * 3600
+    adaptive_update: bool = False   # learn update_delta from the observed change rate
+    min_update_delta: int = 3600
+    max_update_delta: int = 24 * 3600
     timeout: int = 5
     allow_no_results: bool = False
+    probe: bool = False   # skip rendering when a plain HTTP request shows no change
+    probe_regex: str = None   # only hash this region of the response
     block_external: bool = False
     block_images: bool = True
+    block_profile: str = None   # named set of blocked resource types and domains, see parsers.base.BLOCK_PROFILES
+    block_resource_types: List[str] = field(default_factory=list)
+    block_domains: List[str] = field(default_factory=list)
+    block_by_extension: bool = False   # match blocked resource types by url extension (misses extension-less urls)
+    count_requests: bool = False   # count the allowed requests and bytes, costs a callback per request
     login_xpath: str = None
     xpath: str = None
     group_xpath: str = None
@@ -51,16 +85,23 @@ class Query:
     text_xpaths: List[str] = field(default_factory=list)
     text_delimiter: str = ', '
     link_xpath: str = '.'
+    batch_extraction: bool = True   # extract all rows with a single page.evaluate call
     pages: int = 1
     next_page_xpath: str = None
     next_page_delay: int = 2   # do not hammer the server
     next_page_timeout: int = 10
+    incremental: bool = False   # stop paginating once a page yields only known keys
+    incremental_min_new_ratio: float = 0
+    scroll_stall_delay: float = 1   # stop waiting for scrolled content once it stops growing, None for a fixed wait
     max_notif: int = 3
+    coalesce_notif: bool = False   # one message per query, fewer telegram calls but clicks only open the query url
     history_size: int = 50
     parser_id: str = 'generic'
     key_generator: Callable = lambda body: body.title
+    key_format: str = None   # 'digest' to store fixed-width key digests instead of the keys
     title_postprocessor: Callable = clean_title
     errors: List[str] = field(default_factory=list)
+    stats: dict = field(default_factory=dict)
 
     def __post_init__(self):
         if not self.id:
@@ -72,26 +113,119 @@ class Query:
         tokens = [get_url_domain_name(self.url)] + words
         return '-'.join([r for r in tokens if len(r) > 1])
 
+    def get_update_delta(self, doc):
+        if self.adaptive_update and doc.update_delta:
+            return doc.update_delta
+        return self.update_delta
+
+    def get_next_update_delta(self, doc, changed):
+        if not doc.updated_ts:
+            return self.update_delta
+        delta = self.get_update_delta(doc)
+        delta = delta / 2 if changed else delta * 2
+        return int(min(max(delta, self.min_update_delta), self.max_update_delta))
+
+    def get_doc_key(self, key):
+        return get_key_digest(key) if self.key_format == 'digest' else key
+
+    def get_next_due_ts(self, doc):
+        return doc.updated_ts + self.get_update_delta(doc)
+
+
+class QueryPlan:
+    # Validated queries and parsers, built once per user settings version
+    def __init__(self, config):
+        self.config = config
+        self.mtime = get_mtime(self.config.SETTINGS_FILE)
+        self.queries = [Query(**r) for r in self.config.QUERIES or []]
+        ids = [r.id for r in self.queries]
+        if len(set(ids)) != len(ids):
+            logger.error(f'duplicate query ids: {sorted({r for r in ids if ids.count(r) > 1})}')
+
+    @cached_property
+    def parsers(self):
+        # Parser modules import playwright, only load them when collecting
+        from bodiez.parsers.base import iterate_parsers
+        res = {r.id: r for r in iterate_parsers()}
+        for query in self.queries:
+            if query.parser_id not in res:
+                logger.error(f'parser {query.parser_id} not found for {query.id}')
+        return res
+
+    def is_outdated(self):
+        return get_mtime(self.config.SETTINGS_FILE) != self.mtime
+
+    def iterate_queries(self):
+        # Fresh copies since queries hold the state of a run
+        for query in self.queries:
+            yield replace(query, errors=[], stats={})
+
+
+class Notifier:
+    # Sends notifications from a background thread once started, synchronously otherwise
+    def __init__(self, config, retries=3, retry_delay=2):
+        self.config = config
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def _send(self, kwargs):
+        for i in range(self.retries):
+            try:
+                notify(
+                    **kwargs,
+                    app_name=NAME,
+                    telegram_bot_token=self.config.TELEGRAM_BOT_TOKEN,
+                    telegram_chat_id=self.config.TELEGRAM_CHAT_ID,
+                )
+                return
+            except Exception:
+                if i == self.retries - 1:
+                    logger.exception(f'failed to notify {kwargs}')
+                else:
+                    time.sleep(self.retry_delay * 2 ** i)
+
+    def _worker(self):
+        while True:
+            kwargs = self.queue.get()
+            if kwargs is None:
+                return
+            self._send(kwargs)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def send(self, **kwargs):
+        if self.thread:
+            self.queue.put(kwargs)
+        else:
+            self._send(kwargs)
+
 
 class Collector:
-    def __init__(self, config, force=False, test=False):
+    def __init__(self, config, force=False, test=False, concurrency=None, plan=None, profile=False):
         self.config = config
         self.force = force
         self.test = test
-        self.parsers = {r.id: r for r in iterate_parsers()}
-        self.store = CloudSyncStore(self.config)
+        self.profile = profile
+        # Profilers only see their own thread
+        self.concurrency = 1 if profile else max(concurrency or self.config.MAX_CONCURRENCY or 1, 1)
+        self.plan = plan or QueryPlan(self.config)
+        self.throttler = DomainThrottler(self.config.DOMAIN_DELAYS)
+        self.store = get_store(self.config)
+        self.notifier = Notifier(self.config)
         self.report = []
 
     def _notify(self, title, body, on_click=None, replace_key=None):
-        notify(
-            title=title,
-            body=body,
-            on_click=on_click,
-            replace_key=replace_key,
-            app_name=NAME,
-            telegram_bot_token=self.config.TELEGRAM_BOT_TOKEN,
-            telegram_chat_id=self.config.TELEGRAM_CHAT_ID,
-        )
+        self.notifier.send(title=title, body=body, on_click=on_click, replace_key=replace_key)
 
     def _notify_new_bodies(self, query, bodies):
         def postprocess(title):
@@ -100,14 +234,22 @@ class Collector:
             return query.title_postprocessor(title) or title
 
         over_limit = len(bodies[query.max_notif:])
+        if query.coalesce_notif:
+            lines = [postprocess(r.title) for r in bodies[:query.max_notif]]
+            if over_limit:
+                lines.append(f'+{over_limit} more results')
+            on_click = bodies[0].url if len(bodies) == 1 else query.url
+            self._notify(title=query.id, body='\n'.join(lines), on_click=on_click)
+            return
         if over_limit:
             self._notify(title=query.id, body=f'+{over_limit} more results', on_click=query.url)
         for body in reversed(bodies[:query.max_notif]):
             self._notify(title=query.id, body=postprocess(body.title), on_click=body.url)
 
-    def _collect_bodies(self, query):
+    def _collect_bodies(self, query, browser_pool=None, known_keys=None):
         try:
-            parser = self.parsers[query.parser_id](self.config, query)
+            parser = self.plan.parsers[query.parser_id](self.config, query, browser_pool=browser_pool,
+                                                        throttler=self.throttler, known_keys=known_keys)
         except KeyError:
             raise Exception(f'parser {query.parser_id} not found')
         bodies = list(parser.parse())
@@ -118,72 +260,185 @@ class Collector:
             self._notify(title=f'{query.id} errors', body=', '.join(sorted(set(query.errors))))
         return bodies
 
-    def _process_query(self, query):
+    def _probe(self, query, doc):
+        state = {
+            'probe_etag': doc.probe_etag,
+            'probe_last_modified': doc.probe_last_modified,
+            'probe_hash': doc.probe_hash,
+        }
+        headers = {}
+        if doc.probe_etag:
+            headers['If-None-Match'] = doc.probe_etag
+        if doc.probe_last_modified:
+            headers['If-Modified-Since'] = doc.probe_last_modified
+        try:
+            self.throttler.wait(query.url, query.next_page_delay)
+            res = fetch(query.url, headers=headers, timeout=query.next_page_timeout)
+        except Exception as e:
+            logger.debug(f'failed to probe {query.id}: {e}')
+            return False, state
+        if res.status == 304:
+            return True, state
+        content = res.content
+        if query.probe_regex:
+            match = re.search(query.probe_regex, res.text, re.DOTALL)
+            content = (match.group(0) if match else '').encode('utf-8')
+        state = {
+            'probe_etag': res.headers.get('ETag'),
+            'probe_last_modified': res.headers.get('Last-Modified'),
+            'probe_hash': hashlib.sha1(content).hexdigest(),
+        }
+        return state['probe_hash'] == doc.probe_hash, state
+
+    def _get_doc_stats(self, query, doc, changed):
+        res = {
+            'runs': doc.runs + 1,
+            'changed_runs': doc.changed_runs + int(changed),
+        }
+        if query.adaptive_update:
+            res['update_delta'] = query.get_next_update_delta(doc, changed=changed)
+        return res
+
+    def _process_query(self, query, browser_pool=None):
         start_ts = time.time()
-        doc = self.store.get(query.url)
-        if not (self.force or self.test or doc.updated_ts < time.time() - query.update_delta):
+        with timed(query.stats, 'store'):
+            doc = self.store.get(query.url)
+        if not (self.force or self.test or query.get_next_due_ts(doc) <= time.time()):
             logger.debug(f'skipped recently updated {query.id}')
             return
-        bodies = self._collect_bodies(query)
+        probe_state = {}
+        if query.probe and not self.test:
+            with timed(query.stats, 'probe'):
+                unchanged, probe_state = self._probe(query, doc)
+            if unchanged and not self.force:
+                logger.debug(f'skipped unchanged {query.id}')
+                doc_stats = self._get_doc_stats(query, doc, changed=False)
+                with timed(query.stats, 'store'):
+                    self.store.set(query.url, doc.keys, key_format=doc.key_format, **doc_stats, **probe_state)
+                self.report.append({
+                    'id': query.id,
+                    'probed': True,
+                    'duration': to_float(time.time() - start_ts),
+                    **doc_stats,
+                    **query.stats,
+                })
+                return
+        key_set = doc.get_key_set(query.key_format)
+        known_keys = key_set if query.incremental and not self.test else None
+        bodies = self._collect_bodies(query, browser_pool=browser_pool, known_keys=known_keys)
         if not (bodies or query.allow_no_results):
             raise Exception('no results')
         if self.test:
-            self._notify_new_bodies(query, bodies)
+            with timed(query.stats, 'notification'):
+                self._notify_new_bodies(query, bodies)
             return
-        new_bodies = [r for r in bodies if r.key not in doc.keys]
+        new_bodies = [r for r in bodies if query.get_doc_key(r.key) not in key_set]
         if new_bodies:
-            self._notify_new_bodies(query, new_bodies)
-        keys = [r.key for r in bodies]
-        history = [r for r in doc.keys if r not in keys]
-        self.store.set(query.url, keys + history[:query.history_size])
+            with timed(query.stats, 'notification'):
+                self._notify_new_bodies(query, new_bodies)
+        keys = key_set.merge([query.get_doc_key(r.key) for r in bodies], query.history_size)
+        doc_stats = self._get_doc_stats(query, doc, changed=bool(new_bodies))
+        with timed(query.stats, 'store'):
+            self.store.set(query.url, keys, key_format=query.key_format, **doc_stats, **probe_state)
         self.report.append({
             'id': query.id,
             'collected': len(bodies),
             'new': [asdict(r) for r in new_bodies],
             'duration': to_float(time.time() - start_ts),
+            **doc_stats,
+            **query.stats,
         })
 
-    def run(self, url_id=None):
-        start_ts = time.time()
-        failed_queries = []
-        for query_args in self.config.QUERIES:
-            query = Query(**query_args)
+    def iterate_queries(self, url_id=None, query_ids=None):
+        for query in self.plan.iterate_queries():
             if not (query.active or self.test):
                 continue
             if url_id and query.id != url_id:
                 continue
-            logger.debug(f'processing {query.id}:\n{pformat(asdict(query), width=160)}')
-            try:
-                self._process_query(query)
-            except Exception:
-                logger.exception(f'failed to process {query.id}')
-                failed_queries.append(query)
+            if query_ids is not None and query.id not in query_ids:
+                continue
+            yield query
+
+    def _profile(self, query):
+        if not self.profile:
+            return nullcontext()
+        from bodiez.profiler import profile
+        return profile(query.id, self.config.PROFILE_DIR)
+
+    def _run_query(self, query, browser_pool=None):
+        logger.debug(f'processing {query.id}:\n{pformat(asdict(query), width=160)}')
+        start_ts = time.time()
+        try:
+            with self._profile(query):
+                self._process_query(query, browser_pool=browser_pool)
+            return True
+        except Exception:
+            logger.exception(f'failed to process {query.id}')
+            return False
+        finally:
+            logger.debug(f'processed {query.id} in {time.time() - start_ts:.02f} seconds')
+
+    def _worker(self, queries, failed_queries):
+        from bodiez.parsers.base import BrowserPool
+        with BrowserPool(self.config) as browser_pool:
+            while True:
+                try:
+                    query = queries.get_nowait()
+                except queue.Empty:
+                    return
+                if not self._run_query(query, browser_pool=browser_pool):
+                    failed_queries.append(query)
+
+    def _run_workers(self, queries, failed_queries):
+        if self.concurrency > 1:
+            workers = [threading.Thread(target=self._worker, args=(queries, failed_queries))
+                       for _ in range(min(self.concurrency, queries.qsize()))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        else:
+            self._worker(queries, failed_queries)
         if failed_queries:
             self._notify(
                 title='failed queries',
                 body=', '.join(sorted(r.id for r in failed_queries)),
                 replace_key='failed-queries',
             )
+
+    def run(self, url_id=None, query_ids=None):
+        start_ts = time.time()
+        queries = queue.Queue()
+        for query in self.iterate_queries(url_id, query_ids):
+            queries.put(query)
+        failed_queries = []
+        self.notifier.start()
+        try:
+            self._run_workers(queries, failed_queries)
+        finally:
+            self.notifier.close()
+            self.store.flush()
         if self.report:
             logger.info(f'report:\n{to_json(self.report)}')
-        logger.info(f'processed in {time.time() - start_ts:.02f} seconds')
+        if self.store.stats:
+            logger.info(f'store stats:\n{to_json(self.store.stats)}')
+        metrics.export(self.config, self.report, self.store.stats)
+        queries_duration = sum(r['duration'] for r in self.report)
+        logger.info(f'processed in {time.time() - start_ts:.02f} seconds '
+                    f'(queries duration: {queries_duration:.02f} seconds, concurrency: {self.concurrency})')
 
     def get_status(self, url_id=None):
-        for query_args in self.config.QUERIES:
-            query = Query(**query_args)
-            if not query.active:
-                continue
-            if url_id and query.id != url_id:
-                continue
-            print(f'{query.id=}\n{to_json(asdict(self.store.get(query.url)))}')
+        for query in self.iterate_queries(url_id):
+            doc = self.store.get(query.url)
+            print(f'{query.id=} next_due={format_ts(query.get_next_due_ts(doc))}\n{to_json(asdict(doc))}')
 
 
-def collect(config, force=False):
-    Collector(config, force=force).run()
+def collect(config, force=False, concurrency=None, profile=False):
+    Collector(config, force=force, concurrency=concurrency, profile=profile).run()
 
 
-def test(config, url_id=None):
-    Collector(config, test=test).run(url_id)
+def test(config, url_id=None, profile=False):
+    Collector(config, test=test, profile=profile).run(url_id)
 
 
 def get_status(config, url_id=None):
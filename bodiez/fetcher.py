@@ -0,0 +1,74 @@
+from dataclasses import dataclass, field
+import logging
+import socket
+import threading
+import time
+import urllib.error
+from urllib.parse import urlparse
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/131.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+
+
+def get_url_domain_name(url):
+    parts = urlparse(url).netloc.split('.')
+    out_parts = parts[1:] if parts[0] == 'www' else parts
+    return '.'.join(out_parts[:-1])
+
+
+class DomainThrottler:
+    # Enforces a minimum delay between requests to the same domain, shared by all workers
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.next_ts = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url, delay=0):
+        domain = get_url_domain_name(url)
+        delay = max(self.delays.get(domain, 0), delay)
+        with self.lock:
+            now = time.time()
+            request_ts = max(self.next_ts.get(domain, 0), now)
+            self.next_ts[domain] = request_ts + delay
+        if request_ts > now:
+            logger.debug(f'waiting {request_ts - now:.02f} seconds for {domain=}')
+            time.sleep(request_ts - now)
+
+
+@dataclass
+class Response:
+    url: str
+    status: int
+    headers: dict = field(default_factory=dict)
+    content: bytes = b''
+
+    @property
+    def text(self):
+        charset = self.headers.get('Content-Type', '').partition('charset=')[2].split(';')[0].strip()
+        return self.content.decode(charset or 'utf-8', errors='replace')
+
+
+def fetch(url, headers=None, method='GET', timeout=30):
+    request = urllib.request.Request(url, headers={**DEFAULT_HEADERS, **(headers or {})}, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as res:
+            return Response(url=res.geturl(), status=res.status, headers=dict(res.headers), content=res.read())
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return Response(url=url, status=e.code, headers=dict(e.headers))
+        raise
+
+
+def is_online(host='8.8.8.8', port=53, timeout=3):
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
@@ -1,8 +1,9 @@
 import argparse
+import logging
 import os
 import sys
 
-from svcutils.service import Config, Service
+from svcutils.service import Config, Service, setup_logging
 
 
 def parse_args():
@@ -13,14 +14,21 @@ def parse_args():
     collect_parser = subparsers.add_parser('collect')
     collect_parser.add_argument('--daemon', action='store_true')
     collect_parser.add_argument('--task', action='store_true')
+    collect_parser.add_argument('--concurrency', type=int)
+    collect_parser.add_argument('--profile', action='store_true')
     status_parser = subparsers.add_parser('status')
     status_parser.add_argument('--id')
     test_parser = subparsers.add_parser('test')
     test_parser.add_argument('--id')
+    test_parser.add_argument('--profile', action='store_true')
+    store_parser = subparsers.add_parser('store')
+    store_parser.add_argument('action', choices=['compact', 'migrate'])
     args = parser.parse_args()
     if not args.cmd:
         parser.print_help()
         sys.exit()
+    if args.cmd == 'collect' and args.profile and (args.daemon or args.task):
+        collect_parser.error('--profile cannot be used with --daemon or --task')
     return args
 
 
@@ -29,35 +37,65 @@ def wrap_collect(*args, **kwargs):
     return collector.collect(*args, **kwargs)
 
 
-def main():
+def wrap_run_daemon(*args, **kwargs):
+    from bodiez import scheduler
+    return scheduler.run_daemon(*args, **kwargs)
+
+
+def get_config(args):
     from bodiez import WORK_DIR
-    args = parse_args()
     path = os.path.realpath(os.path.expanduser(args.path))
-    config = Config(
-        os.path.join(path, 'user_settings.py'),
+    settings_file = os.path.join(path, 'user_settings.py')
+    return Config(
+        settings_file,
+        SETTINGS_FILE=settings_file,
         STATE_DIR=os.path.join(WORK_DIR, 'state'),
+        PROFILE_DIR=os.path.join(WORK_DIR, 'profiles'),
         STORE_DIR=os.path.join(path, 'store'),
+        STORE_BACKEND='json',
+        STORE_DB=os.path.join(WORK_DIR, 'store.db'),
         HEADLESS=not args.headful,
         RUN_DELTA=3600,
+        RETRY_DELTA=1800,
+        MAX_CONCURRENCY=1,
+        DOMAIN_DELAYS={},
+        STORE_WRITE_BEHIND=False,
+        STORE_FLUSH_DELTA=300,
+        METRICS_FILE=None,   # JSON-lines run reports
+        PROMETHEUS_FILE=None,   # textfile collector file, e.g. /var/lib/node_exporter/bodiez.prom
     )
+
+
+def main():
+    from bodiez import NAME, WORK_DIR
+    args = parse_args()
+    setup_logging(path=WORK_DIR, name=NAME)
+    logging.getLogger('asyncio').setLevel(logging.INFO)
+    config = get_config(args)
     if args.cmd == 'collect':
-        service = Service(
-            target=wrap_collect,
-            args=(config,),
-            work_dir=WORK_DIR,
-            run_delta=config.RUN_DELTA,
-            min_uptime=180,
-            requires_online=True,
-        )
         if args.daemon:
-            service.run()
+            wrap_run_daemon(config, concurrency=args.concurrency, config_loader=lambda: get_config(args),
+                            min_uptime=180, requires_online=True)
         elif args.task:
-            service.run_once()
+            Service(
+                target=wrap_collect,
+                args=(config, False, args.concurrency),
+                work_dir=WORK_DIR,
+                run_delta=config.RUN_DELTA,
+                min_uptime=180,
+                requires_online=True,
+            ).run_once()
         else:
-            wrap_collect(config, force=True)
+            wrap_collect(config, force=True, concurrency=args.concurrency, profile=args.profile)
+    elif args.cmd == 'store':
+        from bodiez import store
+        {'compact': store.compact, 'migrate': store.migrate}[args.action](config)
+    elif args.cmd == 'test':
+        from bodiez import collector
+        collector.test(config, url_id=args.id, profile=args.profile)
     else:
         from bodiez import collector
-        {'test': collector.test, 'status': collector.get_status}[args.cmd](config, url_id=args.id)
+        collector.get_status(config, url_id=args.id)
 
 
 if __name__ == '__main__':
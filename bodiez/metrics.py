@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import time
+
+from bodiez.utils import write_file_atomic
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'bodiez'
+
+
+@contextmanager
+def timed(stats, stage):
+    # Accumulates the stage duration in stats['stages'], callers keep stages from nesting
+    start_ts = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = stats.setdefault('stages', {})
+        stages[stage] = round(stages.get(stage, 0) + time.perf_counter() - start_ts, 4)
+
+
+def _escape_label(val):
+    return str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _iterate_prometheus_lines(report, store_stats, ts):
+    metrics = {
+        'query_duration_seconds': ('Query processing duration.', lambda x: {(): x.get('duration')}),
+        'query_collected': ('Number of collected bodies.', lambda x: {(): x.get('collected')}),
+        'query_new': ('Number of new bodies.', lambda x: {(): len(x['new']) if 'new' in x else None}),
+        'query_stage_seconds': ('Query duration by stage.',
+                                lambda x: {(('stage', k),): v for k, v in x.get('stages', {}).items()}),
+    }
+    for name, (description, get_values) in metrics.items():
+        yield f'# HELP {PREFIX}_{name} {description}'
+        yield f'# TYPE {PREFIX}_{name} gauge'
+        for entry in report:
+            for labels, val in get_values(entry).items():
+                if val is None:
+                    continue
+                labels = ','.join(f'{k}="{_escape_label(v)}"' for k, v in (('query', entry['id']),) + labels)
+                yield f'{PREFIX}_{name}{{{labels}}} {val}'
+    yield f'# HELP {PREFIX}_store_stage_seconds Store duration by stage.'
+    yield f'# TYPE {PREFIX}_store_stage_seconds gauge'
+    for stage, val in (store_stats or {}).get('stages', {}).items():
+        yield f'{PREFIX}_store_stage_seconds{{stage="{_escape_label(stage)}"}} {val}'
+    yield f'# HELP {PREFIX}_last_run_timestamp_seconds Last run end time.'
+    yield f'# TYPE {PREFIX}_last_run_timestamp_seconds gauge'
+    yield f'{PREFIX}_last_run_timestamp_seconds {ts:.0f}'
+
+
+def write_prometheus(file, report, store_stats=None, ts=None):
+    # The textfile collector may read at any time, write to a temporary file then rename
+    content = '\n'.join(_iterate_prometheus_lines(report, store_stats, ts or time.time())) + '\n'
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    # Readable by node_exporter, which usually runs as another user
+    write_file_atomic(file, content, mode=0o644)
+
+
+def write_jsonl(file, report, store_stats=None, ts=None):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file, 'a', encoding='utf-8') as fd:
+        fd.write(json.dumps({'ts': ts or time.time(), 'queries': report, 'store': store_stats or {}},
+                            sort_keys=True) + '\n')
+
+
+def export(config, report, store_stats=None):
+    ts = time.time()
+    for file, writer in [(config.METRICS_FILE, write_jsonl), (config.PROMETHEUS_FILE, write_prometheus)]:
+        if not file:
+            continue
+        try:
+            writer(file, report, store_stats, ts=ts)
+        except Exception:
+            logger.exception(f'failed to export metrics to {file}')
@@ -2,24 +2,56 @@ from dataclasses import dataclass
 from contextlib import contextmanager
 import importlib
 import inspect
+import json
 import logging
 import os
 import pkgutil
+import re
 import time
 from urllib.parse import urljoin, urlparse
 
-from playwright.sync_api import TimeoutError
+from playwright.sync_api import TimeoutError, sync_playwright
 from webutils.browser import playwright_context, save_page
 
 from bodiez import WORK_DIR
+from bodiez.fetcher import DomainThrottler, get_url_domain_name
+from bodiez.metrics import timed
+from bodiez.utils import write_file_atomic
 
 logger = logging.getLogger(__name__)
 
-
-def get_url_domain_name(url):
-    parts = urlparse(url).netloc.split('.')
-    out_parts = parts[1:] if parts[0] == 'www' else parts
-    return '.'.join(out_parts[:-1])
+TRACKING_DOMAINS = [
+    'adnxs.com',
+    'adservice.google.com',
+    'amazon-adsystem.com',
+    'criteo.com',
+    'doubleclick.net',
+    'facebook.net',
+    'google-analytics.com',
+    'googlesyndication.com',
+    'googletagmanager.com',
+    'googletagservices.com',
+    'hotjar.com',
+    'outbrain.com',
+    'scorecardresearch.com',
+    'taboola.com',
+]
+RESOURCE_TYPE_EXTENSIONS = {
+    'image': ['apng', 'avif', 'bmp', 'gif', 'ico', 'jpeg', 'jpg', 'png', 'svg', 'webp'],
+    'font': ['eot', 'otf', 'ttf', 'woff', 'woff2'],
+    'media': ['m3u8', 'mp3', 'mp4', 'ogg', 'wav', 'webm'],
+    'stylesheet': ['css'],
+}
+URL_SCHEME_PATTERN = r'^[a-z][a-z0-9+.-]*://'
+BLOCK_PROFILES = {
+    'light': {
+        'resource_types': ['image', 'media', 'font'],
+    },
+    'strict': {
+        'resource_types': ['image', 'media', 'font', 'stylesheet'],
+        'domains': TRACKING_DOMAINS,
+    },
+}
 
 
 @dataclass
@@ -29,31 +61,192 @@ class Body:
     key: str = None
 
 
+class BrowserPool:
+    # Playwright sync objects are bound to their thread, each worker uses its own pool
+    def __init__(self, config):
+        self.config = config
+        self.playwright = None
+        self.browser = None
+        self.contexts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_context(self, state_file):
+        if not self.browser:
+            self.playwright = sync_playwright().start()
+            try:
+                self.browser = self.playwright.chromium.launch(headless=self.config.HEADLESS)
+            except Exception:
+                # A running driver would break any later playwright start in this thread
+                self.playwright.stop()
+                self.playwright = None
+                raise
+        if state_file not in self.contexts:
+            storage_state = state_file if os.path.exists(state_file) else None
+            self.contexts[state_file] = self.browser.new_context(storage_state=storage_state)
+        return self.contexts[state_file]
+
+    def close(self):
+        try:
+            for state_file, context in self.contexts.items():
+                try:
+                    # Workers sharing a state file save it concurrently, never expose a partial file
+                    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+                    write_file_atomic(state_file, json.dumps(context.storage_state()))
+                except Exception:
+                    logger.exception(f'failed to save state {state_file}')
+                try:
+                    context.close()
+                except Exception:
+                    logger.exception(f'failed to close context {state_file}')
+        finally:
+            self.contexts = {}
+            try:
+                if self.browser:
+                    self.browser.close()
+            finally:
+                if self.playwright:
+                    self.playwright.stop()
+                self.browser = None
+                self.playwright = None
+
+
 class BaseParser:
     id = None
 
-    def __init__(self, config, query):
+    def __init__(self, config, query, browser_pool=None, throttler=None, known_keys=None):
         self.config = config
         self.query = query
+        self.browser_pool = browser_pool
+        self.throttler = throttler or DomainThrottler(self.config.DOMAIN_DELAYS)
+        self.known_keys = known_keys
+        self.domain_name = get_url_domain_name(self.query.url)
+        self.block_resource_types, self.block_domains = self._get_block_rules()
+        self.routes = self._get_routes()
+        self.request_stats = None
         self.state_file = os.path.join(self.config.STATE_DIR, f'{urlparse(self.query.url).netloc}.json')
 
+    def _get_block_rules(self):
+        profile = {}
+        if self.query.block_profile:
+            profiles = {**BLOCK_PROFILES, **(self.config.BLOCK_PROFILES or {})}
+            try:
+                profile = profiles[self.query.block_profile]
+            except KeyError:
+                raise Exception(f'block profile {self.query.block_profile} not found')
+        resource_types = set(profile.get('resource_types', [])) | set(self.query.block_resource_types)
+        if self.query.block_images:
+            resource_types.add('image')
+        domains = set(profile.get('domains', [])) | set(self.query.block_domains)
+        return resource_types, domains
+
     def _is_external_domain(self, request):
-        return get_url_domain_name(self.query.url) not in urlparse(request.url).netloc.split('.')
+        return self.domain_name not in urlparse(request.url).netloc.split('.')
 
-    def _request_handler(self, route, request):
+    def _is_blocked_domain(self, request):
+        netloc = urlparse(request.url).netloc
+        return any(netloc == r or netloc.endswith(f'.{r}') for r in self.block_domains)
+
+    def _get_block_reason(self, request):
         if self.query.block_external and self._is_external_domain(request):
-            route.abort()
-            return
-        if self.query.block_images and request.resource_type == 'image':
-            route.abort()
-            return
-        route.continue_()
+            return 'external'
+        if self.block_domains and self._is_blocked_domain(request):
+            return 'domain'
+        if request.resource_type in self.block_resource_types:
+            return request.resource_type
+        return None
+
+    def _abort(self, route, reason):
+        self.request_stats['blocked'] += 1
+        self.request_stats['blocked_by'][reason] = self.request_stats['blocked_by'].get(reason, 0) + 1
+        route.abort()
+
+    def _request_handler(self, route, request):
+        reason = self._get_block_reason(request)
+        if reason:
+            self._abort(route, reason)
+        else:
+            route.continue_()
+
+    def _resource_type_handler(self, route, request):
+        if request.resource_type in self.block_resource_types:
+            self._abort(route, request.resource_type)
+        else:
+            route.continue_()
+
+    def _get_abort_handler(self, reason):
+        def handler(route, request):
+            self._abort(route, reason)
+        return handler
+
+    def _get_routes(self):
+        # Routes are matched by the browser, only the requests matching a pattern reach python
+        if not (self.query.block_external or self.block_domains or self.block_resource_types):
+            return []
+        if not self.query.block_by_extension:
+            return [('**/*', self._request_handler)]
+        routes = []
+        if self.block_resource_types - RESOURCE_TYPE_EXTENSIONS.keys():
+            routes.append(('**/*', self._resource_type_handler))
+        elif self.block_resource_types:
+            extensions = sorted({e for r in self.block_resource_types for e in RESOURCE_TYPE_EXTENSIONS[r]})
+            pattern = re.compile(rf'\.(?:{"|".join(extensions)})(?:[?#]|$)', re.IGNORECASE)
+            routes.append((pattern, self._resource_type_handler))
+        if self.block_domains:
+            domains = '|'.join(re.escape(r) for r in sorted(self.block_domains))
+            pattern = re.compile(rf'{URL_SCHEME_PATTERN}(?:[^/?#]*\.)?(?:{domains})(?:[:/?#]|$)', re.IGNORECASE)
+            routes.append((pattern, self._get_abort_handler('domain')))
+        if self.query.block_external:
+            domain_name = re.escape(self.domain_name)
+            pattern = re.compile(rf'{URL_SCHEME_PATTERN}(?!(?:[^/?#]*\.)?{domain_name}(?:[.:/?#]|$))', re.IGNORECASE)
+            routes.append((pattern, self._get_abort_handler('external')))
+        return routes
+
+    def _request_finished_handler(self, request):
+        self.request_stats['allowed'] += 1
+        try:
+            self.request_stats['allowed_bytes'] += request.sizes()['responseBodySize']
+        except Exception as e:
+            logger.debug(f'failed to get request sizes for {request.url}: {e}')
+
+    def _setup_context(self, context):
+        self.request_stats = self.query.stats.setdefault('requests', {
+            'blocked': 0,
+            'blocked_by': {},
+        })
+        for pattern, handler in self.routes:
+            context.route(pattern, handler)
+        if self.query.count_requests:
+            self.request_stats.setdefault('allowed', 0)
+            self.request_stats.setdefault('allowed_bytes', 0)
+            context.on('requestfinished', self._request_finished_handler)
+
+    def _teardown_context(self, context):
+        for pattern, handler in self.routes:
+            context.unroute(pattern, handler)
+        if self.query.count_requests:
+            context.remove_listener('requestfinished', self._request_finished_handler)
+        for page in context.pages:
+            page.close()
 
     @contextmanager
     def playwright_context(self):
-        with playwright_context(self.state_file, self.config.HEADLESS) as context:
-            context.route('**/*', self._request_handler)
+        if not self.browser_pool:
+            with playwright_context(self.state_file, self.config.HEADLESS) as context:
+                self._setup_context(context)
+                yield context
+            return
+        with timed(self.query.stats, 'browser'):
+            context = self.browser_pool.get_context(self.state_file)
+        self._setup_context(context)
+        try:
             yield context
+        finally:
+            self._teardown_context(context)
 
     def _check_login(self, page, check_delay=5, timeout=120):
         def check():
@@ -77,18 +270,26 @@ class BaseParser:
                 raise Exception('login timeout')
 
     def _load_page(self, context):
-        page = context.new_page()
-        page.goto(self.query.url)
-        self._check_login(page)
+        self._throttle(self.query.url)
+        with timed(self.query.stats, 'navigation'):
+            page = context.new_page()
+            page.goto(self.query.url)
+        with timed(self.query.stats, 'login'):
+            self._check_login(page)
         return page
 
+    def _throttle(self, url):
+        with timed(self.query.stats, 'throttle'):
+            self.throttler.wait(url, self.query.next_page_delay)
+
     def _save_page(self, page, name):
         save_page(page, os.path.join(WORK_DIR, 'debug'), name)
 
     def _wait_for_selector(self, page, selector):
         logger.debug(f'waiting for {selector=} {self.query.timeout=}')
         try:
-            page.wait_for_selector(selector, timeout=self.query.timeout * 1000)
+            with timed(self.query.stats, 'wait'):
+                page.wait_for_selector(selector, timeout=self.query.timeout * 1000)
         except TimeoutError:
             self._save_page(page, 'selector_not_found')
             if not self.query.allow_no_results:
@@ -101,7 +302,9 @@ class BaseParser:
         links = element.locator(f'xpath={self.query.link_xpath}').all()
         if not links:
             return self.query.url
-        val = links[0].get_attribute('href')
+        return self._get_url(links[0].get_attribute('href'))
+
+    def _get_url(self, val):
         if not val:
             return self.query.url
         if val.startswith('http'):
@@ -109,6 +312,18 @@ class BaseParser:
         parsed = urlparse(self.query.url)
         return urljoin(f'{parsed.scheme}://{parsed.netloc}/{parsed.path}', val)
 
+    def _must_load_next_page(self, bodies, page_index):
+        # Incremental crawl: stop paginating once a page yields (almost) only known keys
+        if self.known_keys is None:
+            return True
+        new_count = len([r for r in bodies
+                         if self.query.get_doc_key(self.query.key_generator(r)) not in self.known_keys])
+        if bodies and new_count / len(bodies) > self.query.incremental_min_new_ratio:
+            return True
+        self.query.stats['pages_skipped'] = self.query.pages - page_index - 1
+        logger.debug(f'skipping next pages {self.query.id=} {page_index=} {new_count=}')
+        return False
+
     def _print_element(self, element):
         content = element.evaluate('element => element.outerHTML')
         try:
@@ -2,10 +2,75 @@ from collections import defaultdict
 import logging
 import time
 
+from bodiez.metrics import timed
 from bodiez.parsers.base import BaseParser, Body
 
 logger = logging.getLogger(__name__)
 
+SCROLL_POLL_DELAY = .25
+COUNT_SCRIPT = ('xpath => document.evaluate(xpath, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null)'
+                '.snapshotLength')
+
+# Evaluates all the query xpaths in a single round trip,
+# mimicking the playwright xpath engine (element nodes only, absolute xpaths relative to the root)
+EXTRACT_SCRIPT = """
+({xpath, groupXpath, groupAttrs, textXpaths, filterXpath, linkXpath}) => {
+    const query = (root, xpath) => {
+        if (xpath.startsWith('/') && root.nodeType !== Node.DOCUMENT_NODE) {
+            xpath = '.' + xpath;
+        }
+        const res = document.evaluate(xpath, root, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+        const nodes = [];
+        for (let i = 0; i < res.snapshotLength; i++) {
+            const node = res.snapshotItem(i);
+            if (node.nodeType === Node.ELEMENT_NODE) {
+                nodes.push(node);
+            }
+        }
+        return nodes;
+    };
+    const first = (root, xpath) => query(root, xpath)[0] || null;
+    const getRows = () => {
+        if (!(groupXpath && groupAttrs.length)) {
+            return query(document, xpath).map(element => [element]);
+        }
+        // Group the base elements by bounding box attributes then find the target elements of the largest group
+        const groups = new Map();
+        for (const element of query(document, xpath)) {
+            if (!element.getClientRects().length) {
+                continue;
+            }
+            const rect = element.getBoundingClientRect();
+            const key = JSON.stringify(groupAttrs.map(r => rect[r]));
+            if (!groups.has(key)) {
+                groups.set(key, []);
+            }
+            groups.get(key).push(element);
+        }
+        let baseElements = [];
+        for (const group of groups.values()) {
+            if (group.length >= baseElements.length) {
+                baseElements = group;
+            }
+        }
+        return baseElements.map(element => query(element, groupXpath)).filter(elements => elements.length);
+    };
+    return getRows().map(elements => {
+        const element = elements[0];
+        const texts = textXpaths.length
+            ? textXpaths.map(r => { const e = first(element, r); return e ? e.textContent : null; })
+            : elements.map(e => e.textContent);
+        const filterElement = filterXpath ? first(element, filterXpath) : null;
+        const link = linkXpath ? first(element, linkXpath) : null;
+        return {
+            texts: texts,
+            filter: filterElement ? filterElement.textContent : null,
+            href: link ? link.getAttribute('href') : null,
+        };
+    });
+}
+"""
+
 
 class GenericParser(BaseParser):
     id = 'generic'
@@ -13,6 +78,10 @@ class GenericParser(BaseParser):
     def _find_elements(self, page):
         selector = f'xpath={self.query.xpath}'
         self._wait_for_selector(page, selector)
+        with timed(self.query.stats, 'extraction'):
+            return self._get_element_groups(page, selector)
+
+    def _get_element_groups(self, page, selector):
         if self.query.group_xpath and self.query.group_attrs:
             # Group the base elements then find the target elements using a relative xpath
             groups = defaultdict(list)
@@ -43,6 +112,17 @@ class GenericParser(BaseParser):
                 self.query.errors.append('failed to validate element')
         return True
 
+    def _validate_value(self, val):
+        if self.query.filter_xpath and self.query.filter_callable:
+            try:
+                if val is None:
+                    raise Exception(f'no filter element for {self.query.filter_xpath=}')
+                return self.query.filter_callable(val.strip())
+            except Exception:
+                logger.exception(f'Failed to validate {self.query.id=} {val=}')
+                self.query.errors.append('failed to validate element')
+        return True
+
     def _iterate_text_elements(self, element):
         for xpath in self.query.text_xpaths:
             try:
@@ -58,12 +138,46 @@ class GenericParser(BaseParser):
         texts = [r.text_content().strip() for r in text_elements]
         return self.query.text_delimiter.join(r for r in texts if r)
 
+    def _get_title_from_texts(self, texts):
+        if self.query.text_xpaths:
+            for xpath, text in zip(self.query.text_xpaths, texts):
+                if text is None:
+                    logger.error(f'Failed to find text element for {self.query.id=} {xpath=}')
+        texts = [r.strip() for r in texts if r is not None]
+        return self.query.text_delimiter.join(r for r in texts if r)
+
+    def _iterate_items(self, page):
+        for elements in self._find_elements(page):
+            with timed(self.query.stats, 'extraction'):
+                if not self._validate_element(elements[0]):
+                    continue
+                item = self._get_title(elements), self._get_link(elements[0])
+            yield item
+
+    def _iterate_items_batched(self, page):
+        self._wait_for_selector(page, f'xpath={self.query.xpath}')
+        with timed(self.query.stats, 'extraction'):
+            rows = page.evaluate(EXTRACT_SCRIPT, {
+                'xpath': self.query.xpath,
+                'groupXpath': self.query.group_xpath,
+                'groupAttrs': self.query.group_attrs,
+                'textXpaths': self.query.text_xpaths,
+                'filterXpath': self.query.filter_xpath if self.query.filter_callable else None,
+                'linkXpath': self.query.link_xpath,
+            })
+        for row in rows:
+            if not self._validate_value(row['filter']):
+                continue
+            yield self._get_title_from_texts(row['texts']), self._get_url(row['href'])
+
     def _load_next_page(self, page, page_index=None):
         if self.query.next_page_xpath:
-            time.sleep(self.query.next_page_delay)
+            self._throttle(self.query.url)
             logger.debug(f'loading next page {self.query.id=} {page_index=} {self.query.next_page_xpath=}')
             try:
-                page.locator(f'xpath={self.query.next_page_xpath}').click(timeout=self.query.next_page_timeout * 1000)
+                with timed(self.query.stats, 'pagination'):
+                    page.locator(f'xpath={self.query.next_page_xpath}').click(
+                        timeout=self.query.next_page_timeout * 1000)
             except Exception as e:
                 if page_index == 0:
                     self._save_page(page, 'failed_to_click_next_page')
@@ -72,8 +186,33 @@ class GenericParser(BaseParser):
                     logger.debug(f'failed to click next page {self.query.id=} {page_index=} {self.query.next_page_xpath=}: {e}')
                 return False
         else:
+            with timed(self.query.stats, 'pagination'):
+                return self._scroll_next_page(page, page_index=page_index)
+        return True
+
+    def _scroll_next_page(self, page, page_index=None):
+        if not self.query.scroll_stall_delay:
             page.evaluate('window.scrollBy(0, window.innerHeight)')
             page.wait_for_timeout(self.query.timeout * 1000)
+            return True
+        # Wait for the number of matching elements to grow then settle, capped by the query timeout.
+        # Scroll to the bottom, pages often only load more elements once a sentinel there becomes visible
+        count = base_count = page.evaluate(COUNT_SCRIPT, self.query.xpath)
+        page.evaluate('window.scrollTo(0, document.documentElement.scrollHeight)')
+        start_ts = time.time()
+        end_ts = start_ts + self.query.timeout
+        stall_ts = None
+        while time.time() < end_ts:
+            page.wait_for_timeout(SCROLL_POLL_DELAY * 1000)
+            new_count = page.evaluate(COUNT_SCRIPT, self.query.xpath)
+            if new_count > count:
+                count = new_count
+                stall_ts = time.time() + self.query.scroll_stall_delay
+            elif stall_ts and time.time() >= stall_ts:
+                break
+        logger.debug(f'scrolled {self.query.id=} {page_index=}: {count - base_count} new elements '
+                     f'in {time.time() - start_ts:.02f} seconds')
+        # Keep scrolling even without new elements, the content may be slower than the timeout
         return True
 
     def parse(self):
@@ -81,17 +220,19 @@ class GenericParser(BaseParser):
             page = self._load_page(context)
             seen_titles = set()
             for i in range(self.query.pages):
-                for elements in self._find_elements(page):
-                    if not self._validate_element(elements[0]):
-                        continue
-                    title = self._get_title(elements)
-                    url = self._get_link(elements[0])
+                items = self._iterate_items_batched(page) if self.query.batch_extraction else self._iterate_items(page)
+                page_bodies = []
+                for title, url in items:
                     if title in seen_titles:
                         logger.debug(f'skipping duplicate {self.query.id=} {title=} {url=}')
                         continue
-                    yield Body(title=title, url=url)
+                    body = Body(title=title, url=url)
+                    yield body
+                    page_bodies.append(body)
                     seen_titles.add(title)
 
                 if i < self.query.pages - 1:
+                    if not self._must_load_next_page(page_bodies, page_index=i):
+                        break
                     if not self._load_next_page(page, page_index=i):
                         break
@@ -0,0 +1,121 @@
+import logging
+import threading
+
+from lxml import etree, html
+
+from bodiez.fetcher import fetch
+from bodiez.metrics import timed
+from bodiez.parsers.base import BaseParser, Body
+
+logger = logging.getLogger(__name__)
+
+# Compiled xpaths are not shared across threads
+_local = threading.local()
+
+
+def compile_xpath(xpath):
+    cache = _local.__dict__.setdefault('xpaths', {})
+    if xpath not in cache:
+        cache[xpath] = etree.XPath(xpath)
+    return cache[xpath]
+
+
+class StaticParser(BaseParser):
+    # Server-rendered pages: evaluates the query xpaths with lxml, no browser involved
+    id = 'static'
+
+    def _load_tree(self, url):
+        self._throttle(url)
+        logger.debug(f'fetching {url=}')
+        with timed(self.query.stats, 'navigation'):
+            res = fetch(url, timeout=self.query.next_page_timeout)
+        with timed(self.query.stats, 'extraction'):
+            content = res.text if 'charset=' in res.headers.get('Content-Type', '') else res.content
+            return html.document_fromstring(content, base_url=res.url)
+
+    def _xpath(self, element, xpath):
+        if xpath.startswith('/') and element.getparent() is not None:
+            # Match playwright, which evaluates absolute xpaths relative to the element
+            xpath = f'.{xpath}'
+        return [r for r in compile_xpath(xpath)(element) if isinstance(r, html.HtmlElement)]
+
+    def _check_login(self, tree):
+        if self.query.login_xpath and compile_xpath(self.query.login_xpath)(tree):
+            raise Exception('Interactive login required')
+
+    def _find_elements(self, tree):
+        elements = self._xpath(tree, self.query.xpath)
+        if not (elements or self.query.allow_no_results):
+            raise Exception('no elements found')
+        return elements
+
+    def _validate_element(self, element):
+        if self.query.filter_xpath and self.query.filter_callable:
+            try:
+                val = self._xpath(element, self.query.filter_xpath)[0].text_content().strip()
+                return self.query.filter_callable(val)
+            except Exception:
+                logger.exception(f'Failed to validate {self.query.id=} {element=}')
+                self.query.errors.append('failed to validate element')
+        return True
+
+    def _get_title(self, element):
+        if not self.query.text_xpaths:
+            return element.text_content().strip()
+        texts = []
+        for xpath in self.query.text_xpaths:
+            try:
+                texts.append(self._xpath(element, xpath)[0].text_content().strip())
+            except IndexError:
+                logger.error(f'Failed to find text element for {self.query.id=} {xpath=}')
+        return self.query.text_delimiter.join(r for r in texts if r)
+
+    def _get_link(self, element):
+        if not self.query.link_xpath:
+            return self.query.url
+        links = self._xpath(element, self.query.link_xpath)
+        if not links:
+            return self.query.url
+        return self._get_url(links[0].get('href'))
+
+    def _get_next_page_url(self, tree, page_index=None):
+        if self.query.next_page_xpath:
+            links = self._xpath(tree, self.query.next_page_xpath)
+            if links and links[0].get('href'):
+                return self._get_url(links[0].get('href'))
+            if page_index == 0:
+                self.query.errors.append('failed to find next page')
+        logger.debug(f'no next page {self.query.id=} {page_index=} {self.query.next_page_xpath=}')
+        return None
+
+    def parse(self):
+        if self.query.group_xpath:
+            raise Exception(f'group_xpath is not supported by the {self.id} parser')
+        tree = self._load_tree(self.query.url)
+        self._check_login(tree)
+        seen_titles = set()
+        for i in range(self.query.pages):
+            page_bodies = []
+            with timed(self.query.stats, 'extraction'):
+                elements = self._find_elements(tree)
+            for element in elements:
+                with timed(self.query.stats, 'extraction'):
+                    if not self._validate_element(element):
+                        continue
+                    title = self._get_title(element)
+                    url = self._get_link(element)
+                if title in seen_titles:
+                    logger.debug(f'skipping duplicate {self.query.id=} {title=} {url=}')
+                    continue
+                body = Body(title=title, url=url)
+                yield body
+                page_bodies.append(body)
+                seen_titles.add(title)
+
+            if i < self.query.pages - 1:
+                if not self._must_load_next_page(page_bodies, page_index=i):
+                    break
+                url = self._get_next_page_url(tree, page_index=i)
+                if not url:
+                    break
+                tree = self._load_tree(url)
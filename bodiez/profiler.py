@@ -0,0 +1,55 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import io
+import logging
+import os
+import pstats
+import re
+
+logger = logging.getLogger(__name__)
+
+TOP = 30
+
+
+def _get_base_file(profile_dir, name):
+    os.makedirs(profile_dir, exist_ok=True)
+    name = re.sub(r'[^\w.-]', '_', name)
+    return os.path.join(profile_dir, f'{datetime.now():%Y%m%d-%H%M%S}-{name}')
+
+
+@contextmanager
+def _pyinstrument_profile(profiler, name, profile_dir):
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        file = f'{_get_base_file(profile_dir, name)}.html'
+        with open(file, 'w', encoding='utf-8') as fd:
+            fd.write(profiler.output_html())
+        logger.info(f'saved {name} profile to {file}:\n{profiler.output_text()}')
+
+
+@contextmanager
+def _cprofile_profile(name, profile_dir, top=TOP):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        file = f'{_get_base_file(profile_dir, name)}.prof'
+        profiler.dump_stats(file)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+        logger.info(f'saved {name} profile to {file}:\n{stream.getvalue()}')
+
+
+def profile(name, profile_dir):
+    # Prefer the sampling profiler, its overhead does not skew the playwright callbacks
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        return _cprofile_profile(name, profile_dir)
+    return _pyinstrument_profile(Profiler(), name, profile_dir)
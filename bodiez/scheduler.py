@@ -0,0 +1,121 @@
+import heapq
+import logging
+import time
+
+from bodiez.collector import Collector, QueryPlan, format_ts, get_mtime
+from bodiez.fetcher import is_online
+
+logger = logging.getLogger(__name__)
+
+CHECK_DELTA = 60
+
+
+def get_uptime():
+    try:
+        import psutil
+    except ImportError:
+        # The monotonic clock starts at boot on linux, macos and windows,
+        # the boottime clock also counts the time spent suspended
+        clock_id = getattr(time, 'CLOCK_BOOTTIME', None)
+        return time.clock_gettime(clock_id) if clock_id is not None else time.monotonic()
+    return time.time() - psutil.boot_time()
+
+
+class Scheduler:
+    # Replaces svcutils.Service for the daemon, which runs at a fixed delta,
+    # and applies the same uptime and online checks before each run
+    def __init__(self, config, concurrency=None, config_loader=None, min_uptime=None, requires_online=False):
+        self.config = config
+        self.concurrency = concurrency
+        self.config_loader = config_loader
+        self.min_uptime = min_uptime
+        self.requires_online = requires_online
+        self.plan = None
+        self.queue = None
+
+    def _refresh_plan(self):
+        if not self.plan:
+            self.plan = QueryPlan(self.config)
+            self.queue = None
+            return
+        if not self.plan.is_outdated():
+            return
+        logger.info('reloading user settings')
+        try:
+            config = self.config_loader() if self.config_loader else self.config
+            plan = QueryPlan(config)
+        except Exception:
+            # Keep running the previous settings until the file changes again
+            logger.exception('failed to reload user settings')
+            self.plan.mtime = get_mtime(self.config.SETTINGS_FILE)
+            return
+        self.config, self.plan = config, plan
+        self.queue = None
+
+    def _get_collector(self):
+        return Collector(self.config, concurrency=self.concurrency, plan=self.plan)
+
+    def _schedule(self, collector, queries):
+        now = time.time()
+        for query in queries:
+            due_ts = query.get_next_due_ts(collector.store.get(query.url))
+            if due_ts <= now:
+                # Not updated by the last run (failure or no results)
+                due_ts = now + self.config.RETRY_DELTA
+            logger.debug(f'scheduled {query.id} at {format_ts(due_ts)}')
+            heapq.heappush(self.queue, (due_ts, query.id))
+
+    def _init_queue(self):
+        collector = self._get_collector()
+        self.queue = []
+        for query in collector.iterate_queries():
+            heapq.heappush(self.queue, (query.get_next_due_ts(collector.store.get(query.url)), query.id))
+
+    def run_once(self):
+        self._refresh_plan()
+        if self.queue is None:
+            self._init_queue()
+        if not self.queue:
+            return self.config.RUN_DELTA
+        now = time.time()
+        query_ids = set()
+        while self.queue and self.queue[0][0] <= now:
+            query_ids.add(heapq.heappop(self.queue)[1])
+        if query_ids:
+            collector = self._get_collector()
+            collector.run(query_ids=query_ids)
+            self._schedule(collector, collector.iterate_queries(query_ids=query_ids))
+        if not self.queue:
+            return self.config.RUN_DELTA
+        return max(self.queue[0][0] - time.time(), 0)
+
+    def _get_wait_reason(self):
+        if self.min_uptime:
+            uptime = get_uptime()
+            if uptime < self.min_uptime:
+                return f'uptime {uptime:.0f} < {self.min_uptime} seconds'
+        if self.requires_online and not is_online():
+            return 'offline'
+        return None
+
+    def run(self):
+        while True:
+            reason = self._get_wait_reason()
+            if reason:
+                logger.info(f'waiting to run: {reason}')
+                time.sleep(CHECK_DELTA)
+                continue
+            try:
+                delay = self.run_once()
+            except Exception:
+                logger.exception('failed to run')
+                # Queries popped by the failed run must be scheduled again
+                self.queue = None
+                delay = self.config.RETRY_DELTA
+            if self.queue:
+                logger.info(f'next run at {format_ts(self.queue[0][0])} ({self.queue[0][1]})')
+            time.sleep(delay)
+
+
+def run_daemon(config, concurrency=None, config_loader=None, **kwargs):
+    Scheduler(config, concurrency=concurrency, config_loader=config_loader, **kwargs).run()
@@ -1,25 +1,162 @@
-from dataclasses import asdict, dataclass, field
-from glob import glob
+import base64
+from collections import defaultdict
+from dataclasses import MISSING, asdict, dataclass, field, fields, replace
 import hashlib
 import json
 import logging
+import math
 import os
 from pprint import pformat
 import socket
+import sqlite3
+import threading
 import time
 from typing import List
 
+from bodiez.metrics import timed
+from bodiez.utils import write_file_atomic
+
 HOSTNAME = socket.gethostname()
+DIGEST_SIZE = 8
+RUNS_HISTORY_SIZE = 100   # runs kept per document by the sqlite store
+BASE_FIELDS = {'url', 'keys', 'updated_ts', 'ref'}   # always written, older versions require them
 
 logger = logging.getLogger(__name__)
 
 
+def get_doc_id(url):
+    return hashlib.md5(url.encode('utf-8')).hexdigest()
+
+
+def get_key_digest(key):
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=DIGEST_SIZE).hexdigest()
+
+
+class BloomFilter:
+    # Bit positions are derived from the key digests, which are already uniformly distributed
+    def __init__(self, bits, hash_count):
+        self.bits = bits
+        self.hash_count = hash_count
+
+    @classmethod
+    def from_keys(cls, keys, error_rate=.01):
+        size = max(int(-len(keys) * math.log(error_rate) / math.log(2) ** 2), 64)
+        res = cls(bytearray((size + 7) // 8), max(round(size / max(len(keys), 1) * math.log(2)), 1))
+        for key in keys:
+            res.add(key)
+        return res
+
+    @classmethod
+    def loads(cls, data):
+        hash_count, bits = data.split(':', 1)
+        return cls(bytearray(base64.b64decode(bits)), int(hash_count))
+
+    def dumps(self):
+        return f'{self.hash_count}:{base64.b64encode(self.bits).decode("ascii")}'
+
+    def _iterate_positions(self, key):
+        h1, h2 = int(key[:8], 16), int(key[8:16], 16) | 1
+        size = len(self.bits) * 8
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % size
+
+    def add(self, key):
+        for pos in self._iterate_positions(key):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._iterate_positions(key))
+
+
+class KeySet:
+    # Ordered set of keys, most recent first
+    def __init__(self, keys=None):
+        self.keys = dict.fromkeys(keys or [])
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def merge(self, keys, history_size):
+        res = dict.fromkeys(keys)
+        max_size = len(res) + history_size
+        for key in self.keys:
+            if len(res) >= max_size:
+                break
+            res.setdefault(key)
+        return list(res)
+
+
+class DigestKeySet(KeySet):
+    # Ordered set of key digests, the bloom filter answers most "definitely new" lookups
+    def __init__(self, keys=None, bloom=None):
+        super().__init__(keys)
+        self.bloom = bloom or BloomFilter.from_keys(list(self.keys))
+
+    def __contains__(self, key):
+        return key in self.bloom and key in self.keys
+
+
 @dataclass
 class Document:
     url: str
     keys: List[str] = field(default_factory=list)
     updated_ts: int = 0
     ref: str = None
+    runs: int = 0
+    changed_runs: int = 0
+    update_delta: int = None
+    probe_etag: str = None
+    probe_last_modified: str = None
+    probe_hash: str = None
+    key_format: str = None   # None for the keys as text, 'digest' for fixed-width key digests
+    key_digests: str = None
+    bloom: str = None
+
+    @classmethod
+    def from_dict(cls, data):
+        # Ignore the fields written by newer versions on other hosts
+        names = {r.name for r in fields(cls)}
+        doc = cls(**{k: v for k, v in data.items() if k in names})
+        if doc.key_format == 'digest' and doc.key_digests is not None:
+            raw = base64.b64decode(doc.key_digests)
+            doc.keys = [raw[i:i + DIGEST_SIZE].hex() for i in range(0, len(raw), DIGEST_SIZE)]
+            doc.key_digests = None
+        return doc
+
+    def to_dict(self):
+        data = asdict(self)
+        if self.key_format == 'digest':
+            data['key_digests'] = base64.b64encode(b''.join(bytes.fromhex(r) for r in self.keys)).decode('ascii')
+            data['bloom'] = BloomFilter.from_keys(self.keys).dumps()
+            data['keys'] = []
+        # Omit the fields left to their defaults so older versions on other hosts can still load the file
+        for r in fields(self):
+            if r.name not in BASE_FIELDS and r.default is not MISSING and data[r.name] == r.default:
+                del data[r.name]
+        return data
+
+    @property
+    def key_set(self):
+        if getattr(self, '_key_set', None) is None:
+            if self.key_format == 'digest':
+                self._key_set = DigestKeySet(self.keys, bloom=BloomFilter.loads(self.bloom) if self.bloom else None)
+            else:
+                self._key_set = KeySet(self.keys)
+        return self._key_set
+
+    def get_key_set(self, key_format=None):
+        if key_format == self.key_format:
+            return self.key_set
+        if key_format == 'digest':
+            return DigestKeySet([get_key_digest(r) for r in self.keys])
+        logger.warning(f'cannot convert key digests of {self.url} to text keys')
+        return KeySet()
 
 
 class CloudSyncStore:
@@ -27,31 +164,222 @@ class CloudSyncStore:
         self.config = config
         self.base_dir = self.config.STORE_DIR
         os.makedirs(self.base_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.dir_mtime = None
+        self.files = {}   # file name: (mtime, doc)
+        self.index = {}   # doc id: latest doc
+        self.dirty = {}   # file name: doc waiting to be written
+        self.flush_ts = time.time()
+        self.stats = {}   # updated under the lock
 
     def _get_doc_id(self, url):
-        return hashlib.md5(url.encode('utf-8')).hexdigest()
+        return get_doc_id(url)
 
     def _load_doc(self, file):
         with open(file, 'r', encoding='utf-8') as fd:
-            return Document(**json.load(fd))
+            return Document.from_dict(json.load(fd))
+
+    def _refresh_index(self):
+        # Files are created or replaced by the sync clients, which updates the directory mtime
+        dir_mtime = os.stat(self.base_dir).st_mtime
+        if dir_mtime == self.dir_mtime:
+            return
+        with timed(self.stats, 'index'):
+            self._load_index(dir_mtime)
+
+    def _load_index(self, dir_mtime):
+        files = {}
+        with os.scandir(self.base_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                mtime = entry.stat().st_mtime
+                if self.files.get(entry.name, (None,))[0] == mtime:
+                    files[entry.name] = self.files[entry.name]
+                    continue
+                try:
+                    files[entry.name] = (mtime, self._load_doc(entry.path))
+                    self.stats['files_read'] = self.stats.get('files_read', 0) + 1
+                except Exception:
+                    logger.exception(f'failed to load {entry.path}')
+        self.files = files
+        self.index = {k: self._merge_docs(v) for k, v in self._group_docs().items()}
+        # Do not trust mtimes that may be within the filesystem timestamp resolution
+        self.dir_mtime = dir_mtime if time.time() - dir_mtime > 2 else None
+
+    def _group_docs(self, doc_id=None):
+        docs = {name: doc for name, (mtime, doc) in self.files.items()}
+        docs.update(self.dirty)
+        res = defaultdict(list)
+        for name, doc in docs.items():
+            name_doc_id = name.split('-', 1)[0]
+            if doc_id is None or name_doc_id == doc_id:
+                res[name_doc_id].append(doc)
+        return res
+
+    def _merge_docs(self, docs):
+        # Union of the keys of all the hosts files, most recent first
+        docs = sorted(docs, key=lambda x: x.updated_ts, reverse=True)
+        latest = docs[0]
+        if len(docs) == 1:
+            return latest
+        keys = dict.fromkeys(latest.keys)
+        for doc in docs[1:]:
+            if doc.url == latest.url:
+                for key in doc.get_key_set(latest.key_format):
+                    keys.setdefault(key)
+        # The bloom filter only covers the latest doc keys, let key_set rebuild it
+        return replace(latest, keys=list(keys), bloom=None)
 
     def get(self, url):
-        files = glob(os.path.join(self.base_dir, f'{self._get_doc_id(url)}-*.json'))
-        if not files:
+        with self.lock:
+            self._refresh_index()
+            doc = self.index.get(self._get_doc_id(url))
+        if not doc:
             return Document(url=url)
-        doc = sorted([self._load_doc(r) for r in files], key=lambda x: x.updated_ts)[-1]
         if doc.url != url:
             logger.error(f'mismatching doc for {url}:\n{pformat(asdict(doc), width=160)}')
             raise Exception(f'mismatching doc for {url}')
         return doc
 
-    def set(self, url, keys):
+    def _write_file(self, file, doc):
+        with timed(self.stats, 'write'):
+            write_file_atomic(file, json.dumps(doc.to_dict(), sort_keys=True, indent=4))
+        self.stats['files_written'] = self.stats.get('files_written', 0) + 1
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            self.flush_ts = time.time()
+            for name, doc in dirty.items():
+                file = os.path.join(self.base_dir, name)
+                try:
+                    self._write_file(file, doc)
+                    self.files[name] = (os.stat(file).st_mtime, doc)
+                except Exception:
+                    logger.exception(f'failed to write {file}')
+                    self.dirty.setdefault(name, doc)
+
+    def compact(self):
+        # Fold the hosts files of each document into a single file for this host
+        self.flush()
+        with self.lock:
+            self.dir_mtime = None
+            self._refresh_index()
+            names = defaultdict(list)
+            for name in self.files:
+                names[name.split('-', 1)[0]].append(name)
+            count = 0
+            for doc_id, doc_names in names.items():
+                if len(doc_names) < 2:
+                    continue
+                name = f'{doc_id}-{HOSTNAME}.json'
+                file = os.path.join(self.base_dir, name)
+                self._write_file(file, replace(self.index[doc_id], ref=file))
+                for other_name in doc_names:
+                    if other_name != name:
+                        os.remove(os.path.join(self.base_dir, other_name))
+                count += 1
+            self.dir_mtime = None
+        logger.info(f'compacted {count} documents in {self.base_dir}')
+
+    def set(self, url, keys, **kwargs):
         file = os.path.join(self.base_dir, f'{self._get_doc_id(url)}-{HOSTNAME}.json')
-        data = {
-            'url': url,
-            'keys': keys,
-            'updated_ts': time.time(),
-            'ref': file,
-        }
-        with open(file, 'w', encoding='utf-8') as fd:
-            json.dump(data, fd, sort_keys=True, indent=4)
+        doc = Document(url=url, keys=keys, updated_ts=time.time(), ref=file, **kwargs)
+        name = os.path.basename(file)
+        with self.lock:
+            self.dirty[name] = doc
+            doc_id = self._get_doc_id(url)
+            self.index[doc_id] = self._merge_docs(self._group_docs(doc_id)[doc_id])
+        if not self.config.STORE_WRITE_BEHIND or time.time() - self.flush_ts > (self.config.STORE_FLUSH_DELTA or 0):
+            self.flush()
+
+
+class SqliteStore:
+    def __init__(self, config):
+        self.config = config
+        self.file = self.config.STORE_DB
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.file, check_same_thread=False)
+        self.stats = {}   # updated under the lock
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS documents '
+                              '(id TEXT PRIMARY KEY, url TEXT NOT NULL, updated_ts REAL NOT NULL, data TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS keys '
+                              '(doc_id TEXT NOT NULL, position INTEGER NOT NULL, key TEXT NOT NULL, '
+                              'PRIMARY KEY (doc_id, position))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS keys_key ON keys (doc_id, key)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS runs '
+                              '(doc_id TEXT NOT NULL, ts REAL NOT NULL, data TEXT NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS runs_doc_id ON runs (doc_id, ts)')
+
+    def get(self, url):
+        doc_id = get_doc_id(url)
+        with self.lock, timed(self.stats, 'read'):
+            row = self.conn.execute('SELECT url, updated_ts, data FROM documents WHERE id = ?', (doc_id,)).fetchone()
+            if not row:
+                return Document(url=url)
+            keys = [r[0] for r in self.conn.execute('SELECT key FROM keys WHERE doc_id = ? ORDER BY position',
+                                                    (doc_id,))]
+        if row[0] != url:
+            logger.error(f'mismatching doc for {url}: {row[0]}')
+            raise Exception(f'mismatching doc for {url}')
+        return Document(url=url, keys=keys, updated_ts=row[1], ref=self.file, **json.loads(row[2]))
+
+    def save(self, doc):
+        doc_id = get_doc_id(doc.url)
+        data = {k: v for k, v in asdict(doc).items()
+                if k not in ('url', 'keys', 'updated_ts', 'ref', 'key_digests', 'bloom')}
+        with self.lock, timed(self.stats, 'write'), self.conn:
+            # Never overwrite a newer document, e.g. when re-running a migration after collecting with sqlite
+            cursor = self.conn.execute('INSERT INTO documents (id, url, updated_ts, data) VALUES (?, ?, ?, ?) '
+                                       'ON CONFLICT (id) DO UPDATE SET url = excluded.url, '
+                                       'updated_ts = excluded.updated_ts, data = excluded.data '
+                                       'WHERE excluded.updated_ts > documents.updated_ts',
+                                       (doc_id, doc.url, doc.updated_ts, json.dumps(data, sort_keys=True)))
+            if not cursor.rowcount:
+                logger.debug(f'skipped saving {doc.url}, the stored document is not older')
+                return False
+            self.conn.execute('DELETE FROM keys WHERE doc_id = ?', (doc_id,))
+            self.conn.executemany('INSERT INTO keys (doc_id, position, key) VALUES (?, ?, ?)',
+                                  [(doc_id, i, k) for i, k in enumerate(doc.keys)])
+            self.conn.execute('INSERT INTO runs (doc_id, ts, data) VALUES (?, ?, ?)',
+                              (doc_id, doc.updated_ts, json.dumps({'keys': len(doc.keys), **data}, sort_keys=True)))
+            self.conn.execute('DELETE FROM runs WHERE doc_id = ? AND rowid NOT IN '
+                              '(SELECT rowid FROM runs WHERE doc_id = ? ORDER BY ts DESC LIMIT ?)',
+                              (doc_id, doc_id, RUNS_HISTORY_SIZE))
+        return True
+
+    def set(self, url, keys, **kwargs):
+        self.save(Document(url=url, keys=keys, updated_ts=time.time(), ref=self.file, **kwargs))
+
+    def flush(self):
+        pass
+
+
+def get_store(config):
+    backends = {
+        'json': CloudSyncStore,
+        'sqlite': SqliteStore,
+    }
+    try:
+        backend = backends[config.STORE_BACKEND or 'json']
+    except KeyError:
+        raise Exception(f'store backend {config.STORE_BACKEND} not found')
+    return backend(config)
+
+
+def compact(config):
+    CloudSyncStore(config).compact()
+
+
+def migrate(config):
+    json_store = CloudSyncStore(config)
+    sqlite_store = SqliteStore(config)
+    json_store._refresh_index()
+    count = sum(sqlite_store.save(r) for r in json_store.index.values())
+    logger.info(f'migrated {count}/{len(json_store.index)} documents from {json_store.base_dir} '
+                f'to {sqlite_store.file}')
@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = _get_umask()
+
+
+def write_file_atomic(file, content, mode=0o666):
+    # Write to a temporary file then rename so readers never see a partial file,
+    # with the permissions a plain open() would give
+    fd = tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(file), suffix='.tmp', delete=False)
+    try:
+        with fd:
+            fd.write(content)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.chmod(fd.name, mode & ~UMASK)
+        os.replace(fd.name, file)
+    except Exception:
+        if os.path.exists(fd.name):
+            os.remove(fd.name)
+        raise
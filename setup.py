@@ -13,6 +13,7 @@ setup(
         'svcutils @ https://github.com/jererc/svcutils/archive/refs/heads/main.zip',
         # 'webutils @ git+https://github.com/jererc/webutils.git@main#egg=webutils',
         'webutils @ https://github.com/jererc/webutils/archive/refs/heads/main.zip',
+        'lxml',
     ],
     extras_require={
         'dev': ['flake8', 'pytest'],
@@ -0,0 +1,181 @@
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from svcutils.service import Config
+
+from tests import WORK_DIR
+from bodiez import collector as module
+
+ROWS = 50
+PAGES = 3
+BENCHMARK_DIR = os.path.join(WORK_DIR, 'benchmarks')
+
+
+def get_rows(prefix, start, count):
+    return ''.join(f'<li class="row" style="height: 40px"><a href="/item/{prefix}-{i}">{prefix} item {i}</a></li>'
+                   for i in range(start, start + count))
+
+
+def get_listing_page(index):
+    next_link = f'<a class="next" href="/listing/{index + 1}">next</a>' if index < PAGES - 1 else ''
+    return f'<ul>{get_rows(f"listing-{index}", 0, ROWS)}</ul>{next_link}'
+
+
+def get_scroll_page():
+    return f'''<ul id="rows">{get_rows('scroll', 0, ROWS)}</ul>
+<script>
+let batch = 1, loading = false;
+window.addEventListener('scroll', () => {{
+    if (loading || batch >= {PAGES}) return;
+    loading = true;
+    setTimeout(() => {{
+        let html = '';
+        for (let i = batch * {ROWS}; i < (batch + 1) * {ROWS}; i++) {{
+            html += `<li class="row" style="height: 40px"><a href="/item/scroll-${{i}}">scroll item ${{i}}</a></li>`;
+        }}
+        document.getElementById('rows').insertAdjacentHTML('beforeend', html);
+        batch++;
+        loading = false;
+    }}, 100);
+}});
+</script>'''
+
+
+def get_sentinel_page():
+    # Rows are only loaded once the sentinel below the list becomes visible
+    return f'''<ul id="rows">{get_rows('sentinel', 0, ROWS)}</ul><div id="sentinel" style="height: 1px"></div>
+<script>
+let batch = 1;
+new IntersectionObserver(entries => {{
+    if (!entries[0].isIntersecting || batch >= {PAGES}) return;
+    setTimeout(() => {{
+        let html = '';
+        for (let i = batch * {ROWS}; i < (batch + 1) * {ROWS}; i++) {{
+            html += `<li class="row" style="height: 40px">`
+                + `<a href="/item/sentinel-${{i}}">sentinel item ${{i}}</a></li>`;
+        }}
+        document.getElementById('rows').insertAdjacentHTML('beforeend', html);
+        batch++;
+    }}, 100);
+}}).observe(document.getElementById('sentinel'));
+</script>'''
+
+
+def get_grouped_page():
+    # The main column and the sidebar share the item class, only the largest group is collected
+    def get_items(prefix, count):
+        return ''.join(f'<div class="item"><a href="/item/{prefix}-{i}">{prefix} item {i}</a></div>'
+                       for i in range(count))
+
+    return (f'<div style="display: flex"><div style="width: 600px">{get_items("main", ROWS)}</div>'
+            f'<div style="width: 200px">{get_items("sidebar", 10)}</div></div>')
+
+
+def get_login_page():
+    return f'<form id="login"><input name="password" type="password"></form><ul>{get_rows("login", 0, ROWS)}</ul>'
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts[0] == 'listing':
+            content = get_listing_page(int(parts[1]))
+        elif parts[0] == 'scroll':
+            content = get_scroll_page()
+        elif parts[0] == 'sentinel':
+            content = get_sentinel_page()
+        elif parts[0] == 'grouped':
+            content = get_grouped_page()
+        elif parts[0] == 'login':
+            content = get_login_page()
+        else:
+            content = '<p>item</p>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(f'<html><body>{content}</body></html>'.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        if cls.results:
+            os.makedirs(BENCHMARK_DIR, exist_ok=True)
+            commit = get_commit()
+            file = os.path.join(BENCHMARK_DIR, f'{datetime.now():%Y%m%d-%H%M%S}-{commit or "unknown"}.json')
+            with open(file, 'w') as fd:
+                json.dump({'commit': commit, 'rows': ROWS, 'pages': PAGES, 'results': cls.results}, fd, indent=4)
+            print(f'saved benchmark results to {file}')
+
+    def _run(self, name, path=None, **query_args):
+        config = Config(
+            __file__,
+            QUERIES=[{'url': f'{self.base_url}/{path or name}', 'id': name, 'next_page_delay': 0, **query_args}],
+            STATE_DIR=os.path.join(WORK_DIR, 'benchmark_state'),
+            STORE_DIR=os.path.join(WORK_DIR, 'benchmark_store'),
+            HEADLESS=True,
+        )
+        shutil.rmtree(config.STORE_DIR, ignore_errors=True)
+        collector = module.Collector(config, force=True)
+        start_ts = time.perf_counter()
+        with patch.object(module, 'notify'):
+            collector.run()
+        duration = time.perf_counter() - start_ts
+        report = collector.report[0] if collector.report else {}
+        self.results[name] = {
+            'duration': round(duration, 4),
+            'collected': report.get('collected', 0),
+            'stages': report.get('stages', {}),
+            'store': collector.store.stats,
+        }
+        print(f'{name}: {json.dumps(self.results[name])}')
+        return report
+
+    def test_listing(self):
+        report = self._run('listing', path='listing/0', xpath='//li[@class="row"]', link_xpath='./a',
+                           next_page_xpath='//a[@class="next"]', pages=PAGES)
+        self.assertEqual(report['collected'], ROWS * PAGES)
+
+    def test_infinite_scroll(self):
+        report = self._run('scroll', xpath='//li[@class="row"]', link_xpath='./a', pages=PAGES)
+        self.assertEqual(report['collected'], ROWS * PAGES)
+
+    def test_infinite_scroll_sentinel(self):
+        report = self._run('sentinel', xpath='//li[@class="row"]', link_xpath='./a', pages=PAGES)
+        self.assertEqual(report['collected'], ROWS * PAGES)
+
+    def test_grouped(self):
+        report = self._run('grouped', xpath='//div[@class="item"]', group_xpath='./a', group_attrs=['x', 'width'])
+        self.assertEqual(report['collected'], ROWS)
+
+    def test_login_wall(self):
+        report = self._run('login', xpath='//li[@class="row"]', login_xpath='//form[@id="login"]')
+        self.assertEqual(report, {})
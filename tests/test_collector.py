@@ -1,9 +1,23 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
 from pprint import pprint
+import pstats
+import shutil
+import sys
+import threading
+import time
+from types import SimpleNamespace
 import unittest
+from unittest.mock import MagicMock, patch
+
+from svcutils.service import Config
 
 from tests import WORK_DIR
-from bodiez import collector
+from bodiez import collector, metrics
 from bodiez.parsers import base
+from bodiez.parsers.base import Body
+from bodiez.store import DigestKeySet, Document, KeySet, get_key_digest
 
 
 class CleanTitleTestCase(unittest.TestCase):
@@ -50,6 +64,43 @@ class QueryTestCase(unittest.TestCase):
         self.assertTrue(all(bool(r.id) for r in res))
         self.assertTrue(all(bool(r.url) for r in res))
 
+    def test_adaptive_update(self):
+        query = collector.Query(url='https://1337x.to/user/FitGirl/', update_delta=4 * 3600, adaptive_update=True,
+                                min_update_delta=3600, max_update_delta=12 * 3600)
+        doc = Document(url=query.url)
+        self.assertEqual(query.get_next_update_delta(doc, changed=True), 4 * 3600)
+        doc.updated_ts = time.time()
+        self.assertEqual(query.get_update_delta(doc), 4 * 3600)
+        deltas = []
+        for changed in (False, False, False, True, True, True, True):
+            doc.update_delta = query.get_next_update_delta(doc, changed=changed)
+            deltas.append(doc.update_delta // 3600)
+        self.assertEqual(deltas, [8, 12, 12, 6, 3, 1, 1])
+        self.assertEqual(query.get_next_due_ts(doc), doc.updated_ts + 3600)
+        query.adaptive_update = False
+        self.assertEqual(query.get_next_due_ts(doc), doc.updated_ts + 4 * 3600)
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    def test_1(self):
+        config = Config(
+            __file__,
+            QUERIES=[{'url': 'https://example.com/1', 'id': 'query-1'}],
+            STORE_DIR=os.path.join(WORK_DIR, 'store'),
+        )
+        plan = collector.QueryPlan(config)
+        self.assertFalse(plan.is_outdated())
+        queries = list(collector.Collector(config, plan=plan).iterate_queries())
+        queries[0].errors.append('failed')
+        queries[0].stats['pages'] = 1
+        res = list(collector.Collector(config, plan=plan).iterate_queries())
+        self.assertEqual([r.id for r in res], ['query-1'])
+        self.assertEqual(res[0].errors, [])
+        self.assertEqual(res[0].stats, {})
+
+    def test_clean_title(self):
+        self.assertEqual(collector.clean_title('Some  title (2024) [repack] (extra'), 'Some title')
+
 
 class ParsersTestCase(unittest.TestCase):
     def test_1(self):
@@ -58,3 +109,540 @@ class ParsersTestCase(unittest.TestCase):
         self.assertTrue(res)
         self.assertTrue(all(r.id is not None for r in res))
         self.assertTrue(all(issubclass(r, base.BaseParser) for r in res))
+
+
+class ConcurrencyTestCase(unittest.TestCase):
+    def _run(self, concurrency, delay=.2):
+        config = Config(
+            __file__,
+            QUERIES=[{'url': f'https://example.com/{i}', 'id': f'query-{i}', 'xpath': '//a'} for i in range(4)],
+            STORE_DIR=os.path.join(WORK_DIR, 'store'),
+        )
+        shutil.rmtree(config.STORE_DIR, ignore_errors=True)
+        collector_ = collector.Collector(config, concurrency=concurrency)
+
+        def collect_bodies(query, **kwargs):
+            time.sleep(delay)
+            if query.url.endswith('3'):
+                raise Exception('failed')
+            return [Body(title=query.url, key=query.url)]
+
+        start_ts = time.time()
+        with patch.object(collector, 'notify') as mock_notify, \
+                patch.object(collector_, '_collect_bodies', side_effect=collect_bodies):
+            collector_.run()
+        return collector_, mock_notify, time.time() - start_ts
+
+    def test_1(self):
+        collector_, mock_notify, duration = self._run(concurrency=4)
+        self.assertTrue(duration < .6)
+        self.assertEqual(sorted(r['id'] for r in collector_.report),
+                         ['query-0', 'query-1', 'query-2'])
+        self.assertTrue(all(r['duration'] >= .2 for r in collector_.report))
+        failed_calls = [r for r in mock_notify.call_args_list if r.kwargs['title'] == 'failed queries']
+        self.assertEqual(failed_calls[0].kwargs['body'], 'query-3')
+
+    def test_sequential(self):
+        collector_, mock_notify, duration = self._run(concurrency=1)
+        self.assertTrue(duration >= .8)
+        self.assertEqual(len(collector_.report), 3)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_1(self):
+        config = Config(
+            __file__,
+            QUERIES=[{'url': f'https://example.com/{i}', 'id': f'query-{i}'} for i in range(2)],
+            STORE_DIR=os.path.join(WORK_DIR, 'store'),
+            METRICS_FILE=os.path.join(WORK_DIR, 'metrics', 'metrics.jsonl'),
+            PROMETHEUS_FILE=os.path.join(WORK_DIR, 'metrics', 'bodiez.prom'),
+        )
+        shutil.rmtree(config.STORE_DIR, ignore_errors=True)
+        shutil.rmtree(os.path.dirname(config.METRICS_FILE), ignore_errors=True)
+        collectors = []
+        for force in (False, True):
+            collector_ = collector.Collector(config, force=force)
+            with patch.object(collector, 'notify'), \
+                    patch.object(collector_, '_collect_bodies', return_value=[Body(title='title', key='key')]):
+                collector_.run()
+            collectors.append(collector_)
+        self.assertEqual(sorted(collectors[0].report[0]['stages']), ['notification', 'store'])
+        self.assertEqual(sorted(collectors[1].report[0]['stages']), ['store'])
+        self.assertEqual(collectors[0].store.stats['files_written'], 2)
+
+        with open(config.METRICS_FILE) as fd:
+            lines = [json.loads(r) for r in fd]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual([r['id'] for r in lines[-1]['queries']], ['query-0', 'query-1'])
+        self.assertTrue('stages' in lines[-1]['store'])
+
+        with open(config.PROMETHEUS_FILE) as fd:
+            content = fd.read()
+        self.assertTrue('bodiez_query_collected{query="query-0"} 1\n' in content)
+        self.assertTrue('bodiez_query_stage_seconds{query="query-1",stage="store"}' in content)
+        self.assertTrue('bodiez_store_stage_seconds{stage="write"}' in content)
+        self.assertEqual(os.stat(config.PROMETHEUS_FILE).st_mode & 0o777, 0o644)
+
+    def test_escape_label(self):
+        self.assertEqual(metrics._escape_label('a"b\\c\n'), 'a\\"b\\\\c\\n')
+
+
+class ProfileTestCase(unittest.TestCase):
+    def test_1(self):
+        config = Config(
+            __file__,
+            QUERIES=[{'url': f'https://example.com/{i}', 'id': f'query-{i}'} for i in range(2)],
+            STORE_DIR=os.path.join(WORK_DIR, 'store'),
+            PROFILE_DIR=os.path.join(WORK_DIR, 'profiles'),
+        )
+        shutil.rmtree(config.STORE_DIR, ignore_errors=True)
+        shutil.rmtree(config.PROFILE_DIR, ignore_errors=True)
+        collector_ = collector.Collector(config, concurrency=4, profile=True)
+        self.assertEqual(collector_.concurrency, 1)
+        with patch.dict(sys.modules, {'pyinstrument': None}), \
+                patch.object(collector, 'notify'), \
+                patch.object(collector_, '_collect_bodies', return_value=[Body(title='title', key='key')]):
+            collector_.run()
+        files = sorted(os.listdir(config.PROFILE_DIR))
+        self.assertEqual([r.split('-', 2)[-1] for r in files], ['query-0.prof', 'query-1.prof'])
+        stats = pstats.Stats(os.path.join(config.PROFILE_DIR, files[0]))
+        self.assertTrue(any(r[2] == '_process_query' for r in stats.stats))
+
+
+class BrowserPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config(__file__, STATE_DIR=os.path.join(WORK_DIR, 'state'), HEADLESS=True)
+        self.playwright = MagicMock()
+
+    def test_failed_launch(self):
+        self.playwright.chromium.launch.side_effect = Exception('failed')
+        with patch.object(base, 'sync_playwright') as mock_sync_playwright:
+            mock_sync_playwright.return_value.start.return_value = self.playwright
+            with base.BrowserPool(self.config) as browser_pool:
+                self.assertRaises(Exception, browser_pool.get_context, 'state.json')
+                self.assertEqual(self.playwright.stop.call_count, 1)
+                self.assertEqual(browser_pool.playwright, None)
+        self.assertEqual(self.playwright.stop.call_count, 1)
+
+    def test_failed_close(self):
+        with patch.object(base, 'sync_playwright') as mock_sync_playwright:
+            mock_sync_playwright.return_value.start.return_value = self.playwright
+            browser_pool = base.BrowserPool(self.config)
+            context = browser_pool.get_context(os.path.join(self.config.STATE_DIR, 'state.json'))
+            context.close.side_effect = Exception('failed')
+            self.playwright.chromium.launch.return_value.close.side_effect = Exception('failed')
+            self.assertRaises(Exception, browser_pool.close)
+        self.assertEqual(self.playwright.stop.call_count, 1)
+        self.assertEqual((browser_pool.browser, browser_pool.playwright, browser_pool.contexts), (None, None, {}))
+
+    def test_save_state(self):
+        state_file = os.path.join(self.config.STATE_DIR, 'state.json')
+        shutil.rmtree(self.config.STATE_DIR, ignore_errors=True)
+        with patch.object(base, 'sync_playwright') as mock_sync_playwright:
+            mock_sync_playwright.return_value.start.return_value = self.playwright
+            self.playwright.chromium.launch.return_value.new_context.return_value.storage_state.return_value = {
+                'cookies': [{'name': 'session'}],
+            }
+            with base.BrowserPool(self.config) as browser_pool:
+                browser_pool.get_context(state_file)
+        with open(state_file) as fd:
+            self.assertEqual(json.load(fd), {'cookies': [{'name': 'session'}]})
+        self.assertEqual(os.listdir(self.config.STATE_DIR), ['state.json'])
+
+
+class ScrollTestCase(unittest.TestCase):
+    def _scroll(self, counts, **query_args):
+        from bodiez.parsers import generic
+        counts = iter(counts)
+        last_count = []
+
+        def evaluate(script, arg=None):
+            if script == generic.COUNT_SCRIPT:
+                last_count[:] = [next(counts, last_count[0] if last_count else 0)]
+                return last_count[0]
+
+        page = MagicMock()
+        page.evaluate.side_effect = evaluate
+        page.wait_for_timeout.side_effect = lambda x: time.sleep(x / 1000)
+        config = Config(__file__, STATE_DIR=os.path.join(WORK_DIR, 'state'))
+        parser = generic.GenericParser(config, collector.Query(url='https://example.com', xpath='//a', **query_args))
+        start_ts = time.time()
+        with patch.object(generic, 'SCROLL_POLL_DELAY', .01):
+            res = parser._scroll_next_page(page)
+        return res, time.time() - start_ts, page
+
+    def test_stall(self):
+        res, duration, page = self._scroll([10, 10, 20, 30], timeout=2, scroll_stall_delay=.1)
+        self.assertTrue(res)
+        self.assertTrue(.1 <= duration < .5)
+
+    def test_no_growth(self):
+        res, duration, page = self._scroll([10], timeout=.3, scroll_stall_delay=.1)
+        self.assertTrue(res)
+        self.assertTrue(.3 <= duration < .6)
+
+    def test_timeout(self):
+        res, duration, page = self._scroll(range(10, 1000), timeout=.3, scroll_stall_delay=.1)
+        self.assertTrue(res)
+        self.assertTrue(.3 <= duration < .6)
+
+    def test_fixed_delay(self):
+        res, duration, page = self._scroll([10], timeout=.2, scroll_stall_delay=None)
+        self.assertTrue(res)
+        page.wait_for_timeout.assert_called_once_with(200)
+
+
+class DomainThrottlerTestCase(unittest.TestCase):
+    def test_1(self):
+        throttler = base.DomainThrottler({'example': .2})
+        start_ts = time.time()
+        throttler.wait('https://www.example.com/1')
+        throttler.wait('https://other.com/1', delay=.5)
+        throttler.wait('https://other.com/2')
+        self.assertTrue(.5 <= time.time() - start_ts < .6)
+        throttler.wait('https://www.example.com/2')
+        self.assertTrue(time.time() - start_ts < .6)
+
+    def test_threads(self):
+        throttler = base.DomainThrottler()
+        start_ts = time.time()
+        threads = [threading.Thread(target=throttler.wait, args=('https://example.com/', .1)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(.3 <= time.time() - start_ts < .4)
+
+
+class ProbeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.content = b'<html><body><div id="list">1</div><div id="ts">1</div></body></html>'
+        test_case = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                etag = f'"{hash(test_case.content)}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(test_case.content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+        self.config = Config(__file__, STORE_DIR=os.path.join(WORK_DIR, 'store'))
+        shutil.rmtree(self.config.STORE_DIR, ignore_errors=True)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_1(self):
+        collector_ = collector.Collector(self.config)
+        query = collector.Query(url=self.url, probe=True, next_page_delay=0)
+        doc = Document(url=self.url)
+        unchanged, state = collector_._probe(query, doc)
+        self.assertFalse(unchanged)
+        self.assertTrue(state['probe_etag'])
+        doc = Document(url=self.url, **state)
+        self.assertEqual(collector_._probe(query, doc), (True, state))
+        doc.probe_etag = None
+        self.assertEqual(collector_._probe(query, doc), (True, state))
+        self.content = self.content.replace(b'"list">1', b'"list">2')
+        self.assertFalse(collector_._probe(query, doc)[0])
+
+    def test_regex(self):
+        collector_ = collector.Collector(self.config)
+        query = collector.Query(url=self.url, probe=True, probe_regex=r'<div id="list">.*?</div>', next_page_delay=0)
+        unchanged, state = collector_._probe(query, Document(url=self.url))
+        doc = Document(url=self.url, probe_hash=state['probe_hash'])
+        self.content = self.content.replace(b'"ts">1', b'"ts">2')
+        self.assertTrue(collector_._probe(query, doc)[0])
+        self.content = self.content.replace(b'"list">1', b'"list">2')
+        self.assertFalse(collector_._probe(query, doc)[0])
+
+    def test_process_query(self):
+        collector_ = collector.Collector(self.config)
+        query = collector.Query(url=self.url, probe=True, update_delta=0, next_page_delay=0)
+        with patch.object(collector, 'notify'), \
+                patch.object(collector_, '_collect_bodies', return_value=[Body(title='1', key='1')]) as mock_collect:
+            collector_._process_query(query)
+            time.sleep(.01)
+            collector_._process_query(query)
+        self.assertEqual(mock_collect.call_count, 1)
+        self.assertTrue(collector_.report[-1]['probed'])
+        doc = collector_.store.get(self.url)
+        self.assertEqual(doc.keys, ['1'])
+        self.assertEqual(doc.runs, 2)
+        self.assertTrue(doc.probe_hash)
+
+
+class StaticParserTestCase(unittest.TestCase):
+    def setUp(self):
+        def get_page(index):
+            rows = ''.join(f'<tr><td><a href="/item/{index}-{i}">item {index}-{i}</a></td><td>{i}</td></tr>'
+                           for i in range(5))
+            next_link = f'<a class="next" href="/page/{index + 1}">next</a>' if index < 2 else ''
+            return f'<html><body><table><tbody>{rows}</tbody></table>{next_link}</body></html>'.encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.end_headers()
+                self.wfile.write(get_page(int(self.path.rstrip('/').split('/')[-1] or 0)))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/page/0'
+        self.config = Config(__file__, STATE_DIR=os.path.join(WORK_DIR, 'state'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _parse(self, known_keys=None, **query_args):
+        from bodiez.parsers.static import StaticParser
+        query = collector.Query(url=self.url, parser_id='static', next_page_delay=0, **query_args)
+        return list(StaticParser(self.config, query, known_keys=known_keys).parse()), query
+
+    def test_1(self):
+        bodies, query = self._parse(
+            xpath='//table/tbody/tr/td[1]/a',
+            filter_xpath='../../td[2]',
+            filter_callable=lambda x: int(x) > 1,
+            next_page_xpath='//a[@class="next"]',
+            pages=5,
+        )
+        self.assertEqual([r.title for r in bodies], [f'item {p}-{i}' for p in range(3) for i in range(2, 5)])
+        self.assertEqual(bodies[0].url, f'http://127.0.0.1:{self.server.server_port}/item/0-2')
+        self.assertEqual(query.errors, [])
+
+    def test_text_xpaths(self):
+        bodies, query = self._parse(
+            xpath='//table/tbody/tr',
+            text_xpaths=['./td[1]', '//td[2]'],
+            link_xpath='.//a',
+        )
+        self.assertEqual(bodies[1].title, 'item 0-1, 1')
+        self.assertTrue(bodies[1].url.endswith('/item/0-1'))
+
+    def test_no_results(self):
+        self.assertRaises(Exception, self._parse, xpath='//table/tbody/tr/td[9]')
+        bodies, query = self._parse(xpath='//table/tbody/tr/td[9]', allow_no_results=True)
+        self.assertEqual(bodies, [])
+
+    def test_incremental(self):
+        query_args = {
+            'xpath': '//table/tbody/tr/td[1]/a',
+            'next_page_xpath': '//a[@class="next"]',
+            'pages': 3,
+            'incremental': True,
+        }
+        bodies, query = self._parse(known_keys=set(), **query_args)
+        self.assertEqual(len(bodies), 15)
+        self.assertFalse('pages_skipped' in query.stats)
+
+        known_keys = {f'item 0-{i}' for i in range(5)}
+        bodies, query = self._parse(known_keys=known_keys, **query_args)
+        self.assertEqual(len(bodies), 5)
+        self.assertEqual(query.stats['pages_skipped'], 2)
+
+        known_keys = {f'item 0-{i}' for i in range(4)}
+        bodies, query = self._parse(known_keys=known_keys, **query_args)
+        self.assertEqual(len(bodies), 15)
+        bodies, query = self._parse(known_keys=known_keys, incremental_min_new_ratio=.2, **query_args)
+        self.assertEqual(len(bodies), 5)
+        self.assertEqual(query.stats['pages_skipped'], 2)
+
+    def test_stages(self):
+        bodies, query = self._parse(xpath='//table/tbody/tr/td[1]/a', next_page_xpath='//a[@class="next"]', pages=3)
+        self.assertEqual(sorted(query.stats['stages']), ['extraction', 'navigation', 'throttle'])
+
+
+class NotifierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config(__file__, STORE_DIR=os.path.join(WORK_DIR, 'store'))
+
+    def test_per_body(self):
+        collector_ = collector.Collector(self.config)
+        query = collector.Query(url='https://1337x.to/user/FitGirl/', max_notif=2)
+        bodies = [Body(title=f'title {i} [FitGirl Repack]', url=f'https://1337x.to/{i}') for i in range(4)]
+        with patch.object(collector, 'notify') as mock_notify:
+            collector_._notify_new_bodies(query, bodies)
+        self.assertEqual([r.kwargs['body'] for r in mock_notify.call_args_list],
+                         ['+2 more results', 'title 1', 'title 0'])
+        self.assertEqual([r.kwargs['on_click'] for r in mock_notify.call_args_list],
+                         [query.url, 'https://1337x.to/1', 'https://1337x.to/0'])
+
+    def test_coalesce(self):
+        collector_ = collector.Collector(self.config)
+        query = collector.Query(url='https://1337x.to/user/FitGirl/', max_notif=2, coalesce_notif=True)
+        bodies = [Body(title=f'title {i} [FitGirl Repack]', url=f'https://1337x.to/{i}') for i in range(4)]
+        with patch.object(collector, 'notify') as mock_notify:
+            collector_._notify_new_bodies(query, bodies)
+            collector_._notify_new_bodies(query, bodies[:1])
+        self.assertEqual([r.kwargs['body'] for r in mock_notify.call_args_list],
+                         ['title 0\ntitle 1\n+2 more results', 'title 0'])
+        self.assertEqual([r.kwargs['on_click'] for r in mock_notify.call_args_list],
+                         [query.url, 'https://1337x.to/0'])
+
+    def test_background(self):
+        notifier = collector.Notifier(self.config, retry_delay=.1)
+        calls = []
+
+        def notify(**kwargs):
+            calls.append(kwargs['title'])
+            time.sleep(.1)
+            if len(calls) == 1:
+                raise Exception('failed')
+
+        with patch.object(collector, 'notify', side_effect=notify):
+            notifier.start()
+            start_ts = time.time()
+            for i in range(3):
+                notifier.send(title=str(i), body='body')
+            self.assertTrue(time.time() - start_ts < .1)
+            notifier.close()
+        self.assertEqual(calls, ['0', '0', '1', '2'])
+
+
+class RequestBlockingTestCase(unittest.TestCase):
+    def _get_parser(self, **query_args):
+        config = Config(__file__, STATE_DIR=os.path.join(WORK_DIR, 'state'))
+        return base.BaseParser(config, collector.Query(url='https://www.1337x.to/user/FitGirl/', **query_args))
+
+    def _get_reasons(self, parser):
+        requests = [
+            ('https://www.1337x.to/css/main.css', 'stylesheet'),
+            ('https://static.1337x.to/logo.png', 'image'),
+            ('https://fonts.gstatic.com/font.woff2', 'font'),
+            ('https://www.googletagmanager.com/gtag.js', 'script'),
+            ('https://1337x.to/js/main.js', 'script'),
+        ]
+        return [parser._get_block_reason(SimpleNamespace(url=u, resource_type=t)) for u, t in requests]
+
+    def test_1(self):
+        self.assertEqual(self._get_reasons(self._get_parser()), [None, 'image', None, None, None])
+        self.assertEqual(self._get_reasons(self._get_parser(block_images=False)), [None] * 5)
+        self.assertEqual(self._get_reasons(self._get_parser(block_external=True)),
+                         [None, 'image', 'external', 'external', None])
+        self.assertEqual(self._get_reasons(self._get_parser(block_profile='light')),
+                         [None, 'image', 'font', None, None])
+        self.assertEqual(self._get_reasons(self._get_parser(block_profile='strict')),
+                         ['stylesheet', 'image', 'font', 'domain', None])
+        self.assertEqual(self._get_reasons(self._get_parser(block_resource_types=['script'],
+                                                            block_domains=['gstatic.com'])),
+                         [None, 'image', 'domain', 'script', 'script'])
+        self.assertRaises(Exception, self._get_parser, block_profile='unknown')
+
+    def _route(self, parser, url, resource_type):
+        route = MagicMock()
+        for pattern, handler in reversed(parser.routes):
+            if pattern == '**/*' or pattern.search(url):
+                handler(route, SimpleNamespace(url=url, resource_type=resource_type))
+                return route.abort.called
+        return False
+
+    def test_routes(self):
+        requests = [
+            ('https://www.1337x.to/css/main.css?v=2', 'stylesheet'),
+            ('https://static.1337x.to/logo.PNG', 'image'),
+            ('https://1337x.to:443/', 'document'),
+            ('https://a1337x.to/', 'document'),
+            ('https://cdn.com/1337x.js', 'script'),
+            ('https://fonts.gstatic.com/font.woff2', 'font'),
+            ('https://www.googletagmanager.com/gtag.js', 'script'),
+            ('https://1337x.to/js/main.js', 'script'),
+        ]
+        for query_args in ({}, {'block_images': False}, {'block_external': True}, {'block_profile': 'strict'},
+                           {'block_resource_types': ['script'], 'block_domains': ['gstatic.com']},
+                           {'block_by_extension': True, 'block_profile': 'strict'},
+                           {'block_by_extension': True, 'block_resource_types': ['script']}):
+            parser = self._get_parser(**query_args)
+            parser.request_stats = {'blocked': 0, 'blocked_by': {}}
+            for url, resource_type in requests:
+                request = SimpleNamespace(url=url, resource_type=resource_type)
+                self.assertEqual(self._route(parser, url, resource_type), bool(parser._get_block_reason(request)),
+                                 (query_args, url))
+        self.assertEqual(self._get_parser(block_images=False).routes, [])
+        self.assertEqual([r[0] for r in self._get_parser().routes], ['**/*'])
+        self.assertEqual(len(self._get_parser(block_by_extension=True).routes), 1)
+        self.assertNotEqual(self._get_parser(block_by_extension=True).routes[0][0], '**/*')
+
+    def test_count_requests(self):
+        for count_requests, expected in [(False, {'blocked': 0, 'blocked_by': {}}),
+                                         (True, {'blocked': 0, 'blocked_by': {}, 'allowed': 0, 'allowed_bytes': 0})]:
+            parser = self._get_parser(count_requests=count_requests)
+            context = MagicMock()
+            parser._setup_context(context)
+            self.assertEqual(context.on.called, count_requests)
+            self.assertEqual(parser.query.stats['requests'], expected)
+            parser._teardown_context(context)
+            self.assertEqual(context.remove_listener.called, count_requests)
+
+
+class KeyHistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config(__file__, STORE_DIR=os.path.join(WORK_DIR, 'store'))
+        shutil.rmtree(self.config.STORE_DIR, ignore_errors=True)
+
+    def test_merge(self):
+        key_set = KeySet(['4', '3', '2', '1'])
+        self.assertEqual(key_set.merge(['6', '5', '3'], history_size=2), ['6', '5', '3', '4', '2'])
+        self.assertEqual(key_set.merge(['5', '5'], history_size=0), ['5'])
+        self.assertEqual(key_set.merge([], history_size=10), ['4', '3', '2', '1'])
+
+    def test_benchmark(self):
+        history_size = 50000
+        query = collector.Query(url='https://1337x.to/user/FitGirl/', history_size=history_size, update_delta=0)
+        collector_ = collector.Collector(self.config)
+        collector_.store.set(query.url, [f'key {i}' for i in range(history_size)])
+        bodies = [Body(title=f'key {i}', key=f'key {i}') for i in range(-1000, 1000)]
+        with patch.object(collector, 'notify'), \
+                patch.object(collector_, '_collect_bodies', return_value=bodies):
+            start_ts = time.time()
+            collector_._process_query(query)
+            duration = time.time() - start_ts
+        print(f'processed {len(bodies)} bodies with {history_size} history keys in {duration:.03f} seconds')
+        self.assertTrue(duration < 1)
+        self.assertEqual(len(collector_.report[0]['new']), 1000)
+        doc = collector_.store.get(query.url)
+        self.assertEqual(len(doc.keys), 1000 + history_size)
+        self.assertEqual(doc.keys[:2], ['key -1000', 'key -999'])
+        self.assertEqual(doc.keys[-1], f'key {history_size - 1}')
+
+    def test_digest(self):
+        query = collector.Query(url='https://1337x.to/user/FitGirl/', update_delta=0, key_format='digest')
+        collector_ = collector.Collector(self.config)
+        collector_.store.set(query.url, ['key 1', 'key 0'])
+        bodies = [Body(title=f'key {i}', key=f'key {i}') for i in (3, 2, 1)]
+        with patch.object(collector, 'notify'), \
+                patch.object(collector_, '_collect_bodies', return_value=bodies):
+            collector_._process_query(query)
+            self.assertEqual([r['title'] for r in collector_.report[-1]['new']], ['key 3', 'key 2'])
+            doc = collector.get_store(self.config).get(query.url)
+            self.assertEqual(doc.key_format, 'digest')
+            self.assertEqual(doc.keys, [get_key_digest(f'key {i}') for i in (3, 2, 1, 0)])
+            bodies.insert(0, Body(title='key 4', key='key 4'))
+            collector_._process_query(query)
+            self.assertEqual([r['title'] for r in collector_.report[-1]['new']], ['key 4'])
+
+    def test_bloom_filter(self):
+        keys = [get_key_digest(f'key {i}') for i in range(10000)]
+        key_set = DigestKeySet(keys)
+        self.assertTrue(all(r in key_set.bloom for r in keys))
+        other_keys = [get_key_digest(f'other {i}') for i in range(10000)]
+        false_positives = len([r for r in other_keys if r in key_set.bloom])
+        self.assertTrue(false_positives < 200, false_positives)
+        self.assertFalse(any(r in key_set for r in other_keys))
@@ -9,7 +9,8 @@ from svcutils.service import Config
 
 from tests import WORK_DIR
 from bodiez import collector as module
-from bodiez.parsers.base import Body
+from bodiez.parsers.base import Body, BrowserPool
+from bodiez.parsers.generic import GenericParser
 
 
 def remove_path(path):
@@ -166,6 +167,41 @@ class CollectTestCase(BaseTestCase):
             headless=False,
         )
 
+    def test_browser_pool(self):
+        config = Config(
+            __file__,
+            STATE_DIR=os.path.join(WORK_DIR, 'state'),
+            STORE_DIR=os.path.join(WORK_DIR, 'store'),
+            HEADLESS=True,
+        )
+        collector = module.Collector(config)
+        with BrowserPool(config) as browser_pool:
+            for url in ('https://1337x.to/user/FitGirl/', 'https://1337x.to/user/DODI/'):
+                start_ts = time.time()
+                bodies = collector._collect_bodies(module.Query(url=url, xpath='//table/tbody/tr/td[1]/a[2]'),
+                                                   browser_pool=browser_pool)
+                print(f'collected {len(bodies)} bodies from {url} in {time.time() - start_ts:.02f} seconds')
+                self.assertTrue(bodies)
+            self.assertEqual(len(browser_pool.contexts), 1)
+            self.assertFalse(list(browser_pool.contexts.values())[0].pages)
+
+    def test_block_profiles(self):
+        results = {}
+        for block_profile in (None, 'light', 'strict'):
+            bodies, query = self._collect(
+                {
+                    'url': 'https://fitgirl-repacks.site/category/lossless-repack/',
+                    'xpath': '//article/header/h1/a',
+                    'block_images': False,
+                    'block_profile': block_profile,
+                    'count_requests': True,
+                },
+            )
+            self.assertTrue(bodies)
+            results[block_profile] = query.stats['requests']
+        pprint(results)
+        self.assertTrue(results['strict']['allowed_bytes'] < results[None]['allowed_bytes'])
+
     def test_timeout(self):
         self.assertRaises(
             Exception,
@@ -190,6 +226,76 @@ class CollectTestCase(BaseTestCase):
         self.assertEqual(query.errors, [])
 
 
+class BatchExtractionTestCase(BaseTestCase):
+    def _benchmark(self, query_dict):
+        config = Config(
+            __file__,
+            STATE_DIR=os.path.join(WORK_DIR, 'state'),
+            STORE_DIR=os.path.join(WORK_DIR, 'store'),
+            HEADLESS=True,
+        )
+        collector = module.Collector(config)
+        results = {}
+        with BrowserPool(config) as browser_pool:
+            for batch_extraction in (False, True):
+                query = module.Query(**query_dict, batch_extraction=batch_extraction)
+                parser = GenericParser(config, query, browser_pool=browser_pool, throttler=collector.throttler)
+                with parser.playwright_context() as context:
+                    page = parser._load_page(context)
+                    items_callable = parser._iterate_items_batched if batch_extraction else parser._iterate_items
+                    start_ts = time.time()
+                    items = list(items_callable(page))
+                    results[batch_extraction] = items, time.time() - start_ts
+        (legacy_items, legacy_duration), (items, duration) = results[False], results[True]
+        print(f'extracted {len(items)} items in {legacy_duration:.03f} seconds (legacy) '
+              f'vs {duration:.03f} seconds (batched)')
+        self.assertTrue(items)
+        self.assertEqual(items, legacy_items)
+        self.assertTrue(duration < legacy_duration)
+
+    def test_1337x(self):
+        self._benchmark({
+            'url': 'https://1337x.to/user/FitGirl/',
+            'xpath': '//table/tbody/tr/td[1]/a[2]',
+            'filter_xpath': '../../td[3]',
+            'filter_callable': lambda x: int(x) > 50,
+        })
+
+    def test_text_xpaths(self):
+        self._benchmark({
+            'url': 'https://kitesurf.mu/index.php?id_category=902&controller=category&id_lang=1',
+            'xpath': '//div[@class="product-miniature-information"]',
+            'text_xpaths': [
+                './/a',
+                './/span[@class="price"]',
+            ],
+            'link_xpath': './/a',
+            'block_external': True,
+        })
+
+    def test_fb_marketplace(self):
+        self._benchmark({
+            'url': 'https://www.facebook.com/marketplace/108433389181024/propertyforsale',
+            'xpath': '//img',
+            'group_xpath': '../../../../../../../div[2]/div',
+            'group_attrs': ['width', 'height'],
+            'link_xpath': '../../..',
+        })
+
+    def test_fb_marketplace_text_xpaths(self):
+        self._benchmark({
+            'url': 'https://www.facebook.com/marketplace/108433389181024/propertyforsale',
+            'xpath': '//img',
+            'group_xpath': '../../../../../../../div[2]',
+            'group_attrs': ['width', 'height'],
+            'text_xpaths': [
+                './div[1]',
+                './div[3]',
+            ],
+            'link_xpath': '../..',
+        })
+
+
 class LoginTestCase(BaseTestCase):
     def setUp(self):
         super().setUp()
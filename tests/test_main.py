@@ -0,0 +1,45 @@
+from contextlib import redirect_stderr
+import io
+import os
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+
+from bodiez import main
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+STATUS_IMPORT_BUDGET = 500000   # microseconds
+
+
+def get_import_times(*modules):
+    # Import the modules the command needs without running main(), which would log to the real work dir
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get('PYTHONPATH')]))}
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {", ".join(modules)}'],
+                         capture_output=True, text=True, env=env, check=True)
+    # import time: self [us] | cumulative | imported package
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split(':', 1)[1].split('|')
+        if not name[1:].startswith(' '):   # top level imports only
+            times[name.strip()] = int(cumulative)
+    return times, res.stderr
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    def test_status(self):
+        times, output = get_import_times('bodiez.main', 'bodiez.collector', 'bodiez.store')
+        self.assertFalse('playwright' in output)
+        self.assertFalse('bodiez.parsers' in output)
+        total = sum(times.values())
+        print(f'status imports: {total} us')
+        self.assertTrue(total < STATUS_IMPORT_BUDGET, sorted(times.items(), key=lambda x: x[1])[-10:])
+
+    def test_profile_args(self):
+        for args in (['collect', '--daemon', '--profile'], ['collect', '--task', '--profile']):
+            with patch.object(sys, 'argv', ['bodiez', *args]), redirect_stderr(io.StringIO()):
+                self.assertRaises(SystemExit, main.parse_args)
+        with patch.object(sys, 'argv', ['bodiez', 'collect', '--profile']):
+            self.assertTrue(main.parse_args().profile)
@@ -0,0 +1,164 @@
+import os
+import shutil
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from svcutils.service import Config
+
+from tests import WORK_DIR
+from bodiez import collector, scheduler as module
+from bodiez.parsers.base import Body
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config(
+            __file__,
+            QUERIES=[
+                {'url': 'https://example.com/1', 'id': 'query-1', 'update_delta': 1},
+                {'url': 'https://example.com/2', 'id': 'query-2', 'update_delta': 3},
+                {'url': 'https://example.com/3', 'id': 'query-3', 'update_delta': 1, 'active': False},
+            ],
+            STORE_DIR=os.path.join(WORK_DIR, 'store'),
+            RUN_DELTA=3600,
+            RETRY_DELTA=60,
+        )
+        shutil.rmtree(self.config.STORE_DIR, ignore_errors=True)
+
+    def _run_once(self, scheduler):
+        processed = []
+
+        def collect_bodies(query, **kwargs):
+            processed.append(query.id)
+            return [Body(title=query.url, key=query.url)]
+
+        with patch.object(collector, 'notify'), \
+                patch.object(collector.Collector, '_collect_bodies', side_effect=collect_bodies):
+            delay = scheduler.run_once()
+        return sorted(processed), delay
+
+    def test_1(self):
+        scheduler = module.Scheduler(self.config)
+        processed, delay = self._run_once(scheduler)
+        self.assertEqual(processed, ['query-1', 'query-2'])
+        self.assertTrue(.9 < delay <= 1)
+        self.assertEqual([r[1] for r in sorted(scheduler.queue)], ['query-1', 'query-2'])
+
+        processed, delay = self._run_once(scheduler)
+        self.assertEqual(processed, [])
+
+        time.sleep(delay)
+        processed, delay = self._run_once(scheduler)
+        self.assertEqual(processed, ['query-1'])
+        self.assertTrue(.9 < delay <= 1)
+
+    def test_failure(self):
+        scheduler = module.Scheduler(self.config)
+        with patch.object(collector, 'notify'), \
+                patch.object(collector.Collector, '_collect_bodies', side_effect=Exception('failed')):
+            delay = scheduler.run_once()
+        self.assertTrue(59 < delay <= 60)
+
+    def test_reload(self):
+        settings_file = os.path.join(WORK_DIR, 'user_settings.py')
+        with open(settings_file, 'w') as fd:
+            fd.write('')
+        config = Config(
+            __file__,
+            SETTINGS_FILE=settings_file,
+            QUERIES=self.config.QUERIES,
+            STORE_DIR=self.config.STORE_DIR,
+            RUN_DELTA=3600,
+            RETRY_DELTA=60,
+        )
+        reloaded_config = Config(
+            __file__,
+            SETTINGS_FILE=settings_file,
+            QUERIES=[{'url': 'https://example.com/4', 'id': 'query-4'}],
+            STORE_DIR=self.config.STORE_DIR,
+            RUN_DELTA=3600,
+            RETRY_DELTA=60,
+        )
+        scheduler = module.Scheduler(config, config_loader=lambda: reloaded_config)
+        processed, delay = self._run_once(scheduler)
+        self.assertEqual(processed, ['query-1', 'query-2'])
+        plan = scheduler.plan
+
+        processed, delay = self._run_once(scheduler)
+        self.assertEqual(processed, [])
+        self.assertTrue(scheduler.plan is plan)
+
+        os.utime(settings_file, (time.time() + 10, time.time() + 10))
+        processed, delay = self._run_once(scheduler)
+        self.assertEqual(processed, ['query-4'])
+        self.assertFalse(scheduler.plan is plan)
+        self.assertEqual([r[1] for r in scheduler.queue], ['query-4'])
+
+    def test_reload_failure(self):
+        settings_file = os.path.join(WORK_DIR, 'user_settings.py')
+        with open(settings_file, 'w') as fd:
+            fd.write('')
+        config = Config(
+            __file__,
+            SETTINGS_FILE=settings_file,
+            QUERIES=self.config.QUERIES,
+            STORE_DIR=self.config.STORE_DIR,
+            RUN_DELTA=3600,
+            RETRY_DELTA=60,
+        )
+        config_loader = MagicMock(side_effect=SyntaxError('invalid syntax'))
+        scheduler = module.Scheduler(config, config_loader=config_loader)
+        self._run_once(scheduler)
+        plan = scheduler.plan
+
+        os.utime(settings_file, (time.time() + 10, time.time() + 10))
+        for i in range(2):
+            processed, delay = self._run_once(scheduler)
+            self.assertEqual(processed, [])
+            self.assertTrue(scheduler.plan is plan)
+            self.assertTrue(scheduler.config is config)
+        self.assertEqual(config_loader.call_count, 1)
+        self.assertEqual(sorted(r[1] for r in scheduler.queue), ['query-1', 'query-2'])
+
+    def _run(self, scheduler, sleeps=2):
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            if len(delays) >= sleeps:
+                raise KeyboardInterrupt()
+
+        with patch.object(module.time, 'sleep', side_effect=sleep):
+            self.assertRaises(KeyboardInterrupt, scheduler.run)
+        return delays
+
+    def test_run_failure(self):
+        scheduler = module.Scheduler(self.config)
+        with patch.object(scheduler, '_init_queue', side_effect=OSError('failed')):
+            delays = self._run(scheduler)
+        self.assertEqual(delays, [60, 60])
+        self.assertEqual(scheduler.queue, None)
+
+    def test_run_checks(self):
+        scheduler = module.Scheduler(self.config, min_uptime=180, requires_online=True)
+        with patch.object(module, 'get_uptime', return_value=100), \
+                patch.object(scheduler, 'run_once') as mock_run_once:
+            self.assertEqual(self._run(scheduler), [module.CHECK_DELTA] * 2)
+        mock_run_once.assert_not_called()
+        with patch.object(module, 'get_uptime', return_value=200), \
+                patch.object(module, 'is_online', return_value=False), \
+                patch.object(scheduler, 'run_once') as mock_run_once:
+            self.assertEqual(self._run(scheduler), [module.CHECK_DELTA] * 2)
+        mock_run_once.assert_not_called()
+        with patch.object(module, 'get_uptime', return_value=200), \
+                patch.object(module, 'is_online', return_value=True), \
+                patch.object(scheduler, 'run_once', return_value=10):
+            self.assertEqual(self._run(scheduler), [10, 10])
+
+    def test_uptime(self):
+        with patch.dict('sys.modules', {'psutil': None}):
+            self.assertTrue(module.get_uptime() > 0)
+            with patch.object(module.time, 'CLOCK_BOOTTIME', None, create=True), \
+                    patch.object(module.time, 'monotonic', return_value=300):
+                self.assertEqual(module.get_uptime(), 300)
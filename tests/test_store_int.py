@@ -1,14 +1,16 @@
+import base64
 import json
 import os
 from pprint import pprint
 import shutil
 import time
 import unittest
+from unittest.mock import patch
 
 from svcutils.service import Config
 
 from tests import WORK_DIR
-from bodiez import store
+from bodiez import store, utils
 
 
 def remove_path(path):
@@ -31,58 +33,238 @@ class CloudSyncStoreTestCase(unittest.TestCase):
         self.url2 = 'https://1337x.to/user/DODI/'
         self.titles = [f'body {i}' for i in range(1, 51)]
 
-    def _create_file(self, url, titles, hostname):
+    def _create_file(self, url, keys, hostname, key_format=None):
         file = os.path.join(self.store.base_dir,
                             f'{self.store._get_doc_id(url)}-{hostname}.json')
         data = {
             'url': url,
-            'titles': titles,
+            'keys': keys,
             'updated_ts': time.time(),
             'ref': file,
         }
+        if key_format:
+            data = store.Document(key_format=key_format, **data).to_dict()
         with open(file, 'w', encoding='utf-8') as fd:
             json.dump(data, fd, sort_keys=True, indent=4)
 
     def test_workflow(self):
         doc = self.store.get(self.url2)
         pprint(doc)
-        self.store.set(self.url2, titles=['1', '2'])
+        self.store.set(self.url2, keys=['1', '2'])
 
         doc = self.store.get(self.url)
         pprint(doc)
         self.assertEqual(doc.url, self.url)
-        self.assertEqual(doc.titles, [])
+        self.assertEqual(doc.keys, [])
         self.assertEqual(doc.updated_ts, 0)
 
         time.sleep(.01)
-        self.store.set(self.url, titles=[])
+        self.store.set(self.url, keys=[])
         doc = self.store.get(self.url)
         pprint(doc)
-        self.assertEqual(doc.titles, [])
+        self.assertEqual(doc.keys, [])
 
         set_titles = self.titles[6:16]
         time.sleep(.01)
-        self.store.set(self.url, titles=set_titles)
+        self.store.set(self.url, keys=set_titles)
         doc = self.store.get(self.url)
         pprint(doc)
-        self.assertEqual(doc.titles, set_titles)
+        self.assertEqual(doc.keys, set_titles)
 
         set_titles = self.titles[3:13]
         time.sleep(.01)
-        self.store.set(self.url, titles=set_titles)
+        self.store.set(self.url, keys=set_titles)
         doc = self.store.get(self.url)
         pprint(doc)
-        self.assertEqual(doc.titles, set_titles)
+        self.assertEqual(doc.keys, set_titles)
 
         doc = self.store.get(self.url2)
         pprint(doc)
         self.assertEqual(doc.url, self.url2)
-        self.assertEqual(doc.titles, ['1', '2'])
+        self.assertEqual(doc.keys, ['1', '2'])
         self.assertTrue(doc.updated_ts > 0)
 
         doc = self.store.get(self.url)
-        other_host_titles = ['new_title'] + doc.titles
-        self._create_file(self.url, titles=other_host_titles, hostname='another_host')
+        other_host_keys = ['new_title'] + doc.keys
+        self._create_file(self.url, keys=other_host_keys, hostname='another_host')
         doc = self.store.get(self.url)
         pprint(doc)
-        self.assertEqual(doc.titles, other_host_titles)
+        self.assertEqual(doc.keys, other_host_keys)
+
+    def test_index(self):
+        urls = [f'https://1337x.to/user/{i}/' for i in range(20)]
+        for url in urls:
+            self.store.set(url, keys=[url])
+        self._create_file(urls[0], keys=['other'], hostname='another_host')
+        past_ts = time.time() - 10
+        os.utime(self.store.base_dir, (past_ts, past_ts))
+
+        store_ = store.CloudSyncStore(self.store.config)
+        with patch.object(store.os, 'scandir', side_effect=os.scandir) as mock_scandir:
+            for i in range(3):
+                docs = [store_.get(r) for r in urls]
+        self.assertEqual(mock_scandir.call_count, 1)
+        self.assertEqual(docs[0].keys, ['other', urls[0]])
+        self.assertEqual([r.keys for r in docs[1:]], [[r] for r in urls[1:]])
+
+        store_.set(urls[1], keys=['new'])
+        self.assertEqual(store_.get(urls[1]).keys, ['new'])
+        os.utime(self.store.base_dir, (past_ts, past_ts))
+        self._create_file(urls[2], keys=['other'], hostname='another_host')
+        with patch.object(store_, '_load_doc', side_effect=store_._load_doc) as mock_load_doc:
+            self.assertEqual(store_.get(urls[2]).keys, ['other', urls[2]])
+        self.assertEqual(mock_load_doc.call_count, 1)
+
+    def test_write_behind(self):
+        store_ = store.CloudSyncStore(Config(
+            __file__,
+            STORE_DIR=self.store.base_dir,
+            STORE_WRITE_BEHIND=True,
+            STORE_FLUSH_DELTA=3600,
+        ))
+        file = os.path.join(store_.base_dir, f'{store_._get_doc_id(self.url)}-{store.HOSTNAME}.json')
+        store_.set(self.url, keys=['1'])
+        store_.set(self.url, keys=['2', '1'])
+        self.assertFalse(os.path.exists(file))
+        self.assertEqual(store_.get(self.url).keys, ['2', '1'])
+        self._create_file(self.url2, keys=['other'], hostname='another_host')
+        self.assertEqual(store_.get(self.url).keys, ['2', '1'])
+
+        store_.flush()
+        self.assertEqual(self.store.get(self.url).keys, ['2', '1'])
+        self.assertEqual([r for r in os.listdir(store_.base_dir) if not r.endswith('.json')], [])
+
+    def test_digest_keys(self):
+        keys = [store.get_key_digest(f'key {i}') for i in range(1000)]
+        self.store.set(self.url, keys=keys, key_format='digest')
+        file = os.path.join(self.store.base_dir, f'{self.store._get_doc_id(self.url)}-{store.HOSTNAME}.json')
+        with open(file, encoding='utf-8') as fd:
+            data = json.load(fd)
+        self.assertEqual(data['keys'], [])
+        self.assertTrue(data['bloom'])
+        self.assertEqual(len(base64.b64decode(data['key_digests'])), 1000 * store.DIGEST_SIZE)
+
+        doc = store.CloudSyncStore(self.store.config).get(self.url)
+        self.assertEqual(doc.keys, keys)
+        self.assertTrue(keys[10] in doc.key_set)
+        self.assertFalse(store.get_key_digest('other') in doc.key_set)
+
+        self.store.set(self.url2, keys=['key 1', 'key 0'])
+        doc = self.store.get(self.url2)
+        self.assertEqual(list(doc.get_key_set('digest')), [store.get_key_digest(f'key {i}') for i in (1, 0)])
+        self.assertEqual(list(self.store.get(self.url).get_key_set(None)), [])
+
+    def test_merge_hosts(self):
+        self._create_file(self.url, keys=['3', '2', '1'], hostname='host1')
+        time.sleep(.01)
+        self._create_file(self.url, keys=['4', '3', '5'], hostname='host2')
+        time.sleep(.01)
+        self.store.set(self.url, keys=['6', '4'])
+        self.store.set(self.url2, keys=['a'])
+        doc = self.store.get(self.url)
+        self.assertEqual(doc.keys, ['6', '4', '3', '5', '2', '1'])
+
+        store.compact(self.store.config)
+        self.assertEqual(sorted(os.listdir(self.store.base_dir)),
+                         sorted(f'{self.store._get_doc_id(r)}-{store.HOSTNAME}.json' for r in (self.url, self.url2)))
+        for store_ in (self.store, store.CloudSyncStore(self.store.config)):
+            doc = store_.get(self.url)
+            self.assertEqual(doc.keys, ['6', '4', '3', '5', '2', '1'])
+            self.assertEqual(store_.get(self.url2).keys, ['a'])
+
+    def test_write_file(self):
+        self.store.set(self.url, keys=['1'])
+        self.store.set(self.url, keys=['2', '1'])
+        self.assertEqual(os.listdir(self.store.base_dir), [f'{self.store._get_doc_id(self.url)}-{store.HOSTNAME}.json'])
+        file = os.path.join(self.store.base_dir, os.listdir(self.store.base_dir)[0])
+        self.assertEqual(os.stat(file).st_mode & 0o777, 0o666 & ~utils.UMASK)
+        self.assertEqual(self.store.stats['files_written'], 2)
+
+    def test_merge_hosts_digest(self):
+        digests = {r: store.get_key_digest(r) for r in 'abc'}
+        self._create_file(self.url, keys=[digests['a'], digests['b']], hostname='host1', key_format='digest')
+        time.sleep(.01)
+        self._create_file(self.url, keys=[digests['c']], hostname='host2', key_format='digest')
+        key_set = self.store.get(self.url).get_key_set('digest')
+        self.assertTrue(all(r in key_set for r in digests.values()))
+        self.assertFalse(store.get_key_digest('d') in key_set)
+
+    def test_compatibility(self):
+        # Files from newer versions may have unknown fields, files for older versions only have the base fields
+        file = os.path.join(self.store.base_dir, f'{self.store._get_doc_id(self.url)}-host1.json')
+        with open(file, 'w', encoding='utf-8') as fd:
+            json.dump({'url': self.url, 'keys': ['1'], 'updated_ts': time.time(), 'ref': None, 'unknown': 1}, fd)
+        self.assertEqual(self.store.get(self.url).keys, ['1'])
+
+        self.store.set(self.url2, keys=['a'])
+        file = os.path.join(self.store.base_dir, f'{self.store._get_doc_id(self.url2)}-{store.HOSTNAME}.json')
+        with open(file, encoding='utf-8') as fd:
+            data = json.load(fd)
+        self.assertEqual(set(data.keys()), store.BASE_FIELDS)
+
+
+class SqliteStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        remove_path(WORK_DIR)
+        os.makedirs(WORK_DIR)
+        self.config = Config(
+            __file__,
+            STORE_DIR=os.path.join(WORK_DIR, 'store'),
+            STORE_BACKEND='sqlite',
+            STORE_DB=os.path.join(WORK_DIR, 'store.db'),
+        )
+        self.store = store.get_store(self.config)
+        self.url = 'https://1337x.to/user/FitGirl/'
+        self.url2 = 'https://1337x.to/user/DODI/'
+
+    def test_workflow(self):
+        self.assertTrue(isinstance(self.store, store.SqliteStore))
+        doc = self.store.get(self.url)
+        self.assertEqual(doc.keys, [])
+        self.assertEqual(doc.updated_ts, 0)
+
+        self.store.set(self.url, keys=['2', '1'], runs=1, update_delta=3600)
+        self.store.set(self.url2, keys=['a'])
+        doc = self.store.get(self.url)
+        pprint(doc)
+        self.assertEqual(doc.keys, ['2', '1'])
+        self.assertEqual(doc.runs, 1)
+        self.assertEqual(doc.update_delta, 3600)
+        self.assertTrue(doc.updated_ts > 0)
+        self.store.set(self.url, keys=['3', '2'], runs=2)
+        doc = self.store.get(self.url)
+        self.assertEqual(doc.keys, ['3', '2'])
+        self.assertEqual(doc.update_delta, None)
+        self.assertEqual(self.store.get(self.url2).keys, ['a'])
+        runs = self.store.conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+        self.assertEqual(runs, 3)
+
+    def test_migrate(self):
+        json_store = store.CloudSyncStore(self.config)
+        json_store.set(self.url, keys=['2', '1'], runs=3)
+        json_store.set(self.url2, keys=['a'])
+        store.migrate(self.config)
+        for url in (self.url, self.url2):
+            json_doc = json_store.get(url)
+            doc = store.SqliteStore(self.config).get(url)
+            self.assertEqual((doc.keys, doc.updated_ts, doc.runs), (json_doc.keys, json_doc.updated_ts, json_doc.runs))
+
+        store.migrate(self.config)
+        self.assertEqual(self.store.conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0], 2)
+
+        # Documents collected with sqlite since the migration are newer than the json ones
+        time.sleep(.01)
+        self.store.set(self.url, keys=['3', '2', '1'], runs=4)
+        store.migrate(self.config)
+        doc = store.SqliteStore(self.config).get(self.url)
+        self.assertEqual((doc.keys, doc.runs), (['3', '2', '1'], 4))
+        self.assertEqual(self.store.conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0], 3)
+
+    def test_runs_history(self):
+        with patch.object(store, 'RUNS_HISTORY_SIZE', 3):
+            for i in range(5):
+                self.store.set(self.url, keys=[str(i)], runs=i)
+            self.store.set(self.url2, keys=['a'])
+        rows = self.store.conn.execute('SELECT doc_id, data FROM runs ORDER BY ts').fetchall()
+        self.assertEqual([json.loads(r[1])['runs'] for r in rows if r[0] == store.get_doc_id(self.url)], [2, 3, 4])
+        self.assertEqual(len(rows), 4)